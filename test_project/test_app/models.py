@@ -18,7 +18,7 @@ class User(AbstractSocialYeti):
 
     def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
         resize_model_photos(self)
-        super(User, self).save(force_insert=False, force_update=False, using=None, update_fields=None)
+        super(User, self).save(force_insert, force_update, using, update_fields)
 
 
 FollowableModel.register(User)
@@ -42,12 +42,6 @@ class Post(BaseSocialModel):
     comments = GenericRelation(Comment)
     notifications = GenericRelation(Notification)
 
-    def likes_count(self):
-        return self.likes.count()
-
-    def comments_count(self):
-        return self.comments.count()
-
     def identifier(self):
         return "{}".format(self.title)
 
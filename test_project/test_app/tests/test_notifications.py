@@ -1,15 +1,32 @@
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from io import StringIO
 from unittest import mock
 from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.reverse import reverse
 from test_project import settings
 from test_project.test_app.models import Post, Article
 from test_project.test_app.tests.factories import PostFactory, UserFactory
 from yak.rest_core.test import SchemaTestCase
-from yak.rest_notifications.models import create_notification, Notification, NotificationSetting, NotificationType
-from yak.rest_notifications.utils import send_email_notification, send_push_notification
+from yak.rest_notifications.models import create_notification, create_notifications, Notification, \
+    NotificationSetting, NotificationType, PushwooshToken, create_notifications_task
+from yak.rest_notifications.utils import send_email_notification, send_push_notification, notification_renderer, \
+    notification_settings_cache, submit_to_pushwoosh, pushwoosh_queue, push_backends, BasePushBackend, PushMessage, \
+    email_queue, send_email_notifications, unread_notification_counter, get_notification_broker, \
+    send_push_notifications, InProcessSubscription
+from yak.rest_social_network.models import Comment
 from yak.settings import yak_settings
 
 
@@ -17,7 +34,62 @@ User = get_user_model()
 
 
 def mockPushNotificationHandler(receiver, message, deep_link=None):
-    return {"hello": "world"}
+    return {"hello": "world", "deep_link": deep_link}
+
+
+class MockPushBackend(BasePushBackend):
+    sent = []
+
+    def send_many(self, messages):
+        self.sent.extend(messages)
+        return ["sent" for push in messages for receiver in push.receivers]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PushwooshStubServer(object):
+    """
+    Local HTTP server standing in for the Pushwoosh API
+    Replies with the queued status codes (then 200s), and records each request's path, body and client port
+    """
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                stub.requests.append({'path': self.path, 'body': json.loads(body.decode()),
+                                      'port': self.client_address[1]})
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                response = json.dumps({"status_code": status}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        # Kept-alive connections are served on their own threads, so they don't block shutting down
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/json/1.3/'.format(self.server.server_port)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
 
 
 class NotificationsTestCase(SchemaTestCase):
@@ -32,7 +104,7 @@ class NotificationsTestCase(SchemaTestCase):
         self.mock_submit_to_pushwoosh = patcher.start()
         self.mock_submit_to_pushwoosh.return_value = {"status_code": 200}
 
-    @mock.patch('pypushwoosh.client.PushwooshClient.invoke')
+    @mock.patch('yak.rest_notifications.views.invoke_pushwoosh')
     def test_create_pushwoosh_token(self, mock_pushwoosh_client):
         mock_pushwoosh_client.return_value = {"status_code": 200}
 
@@ -65,6 +137,132 @@ class NotificationsTestCase(SchemaTestCase):
         self.assertEqual(mail.outbox[0].body, "You have a notification!")
         self.assertEqual(mail.outbox[0].alternatives, [(message, "text/html")])
 
+    @mock.patch.object(yak_settings, 'EMAIL_BATCH_SIZE', 3)
+    @mock.patch.object(yak_settings, 'EMAIL_BATCH_WINDOW', 60)
+    def test_email_batching(self):
+        """
+        Queued emails are sent over one mail connection, in batches, once the batch is full or when flushed
+        """
+        self.addCleanup(email_queue.flush)
+        receivers = UserFactory.create_batch(5)
+
+        with mock.patch('yak.rest_notifications.utils.get_connection', wraps=get_connection) as mock_get_connection:
+            send_email_notifications(receivers[:2], "<p>Hello</p>", reply_to="reply@example.com")
+            self.assertEqual(len(mail.outbox), 0)
+
+            # Filling the batch sends everything queued, in batches of 3 over one connection
+            send_email_notifications(receivers[2:4], "<p>Hello</p>", reply_to="reply@example.com")
+            self.assertEqual(len(mail.outbox), 4)
+            self.assertEqual(mock_get_connection.call_count, 1)
+
+            send_email_notification(receivers[4], "<p>Hello</p>", reply_to="reply@example.com")
+            self.assertEqual(len(mail.outbox), 4)
+            email_queue.flush()
+            self.assertEqual(len(mail.outbox), 5)
+            self.assertEqual(mock_get_connection.call_count, 2)
+
+        self.assertEqual([email.to for email in mail.outbox], [[receiver.email] for receiver in receivers])
+        self.assertEqual(mail.outbox[0].extra_headers["Reply-To"], "reply@example.com")
+
+    @mock.patch.object(yak_settings, 'EMAIL_DIGEST', True)
+    @mock.patch.object(yak_settings, 'EMAIL_BATCH_WINDOW', 60)
+    def test_email_digest(self):
+        """
+        With `EMAIL_DIGEST`, emails to the same user that are sent together are merged into one
+        """
+        self.addCleanup(email_queue.flush)
+        send_email_notification(self.receiver, "<p>First</p>")
+        send_email_notification(self.reporter, "<p>Other</p>")
+        send_email_notification(self.receiver, "<p>Second</p>")
+        self.assertEqual(len(mail.outbox), 0)
+
+        email_queue.flush()
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, [self.receiver.email])
+        self.assertEqual(mail.outbox[0].alternatives, [("<p>First</p>\n<hr>\n<p>Second</p>", "text/html")])
+        self.assertEqual(mail.outbox[1].to, [self.reporter.email])
+
+    @mock.patch.object(yak_settings, 'PUSHWOOSH_RETRY_BACKOFF', 0)
+    def test_pushwoosh_session(self):
+        """
+        Pushwoosh requests share one kept-alive connection and are retried while Pushwoosh is unavailable
+        """
+        PushwooshToken.objects.create(user=self.receiver, token="ABC123")
+        self.mock_submit_to_pushwoosh.side_effect = submit_to_pushwoosh
+
+        with PushwooshStubServer(statuses=[503, 503]) as stub:
+            with mock.patch.object(yak_settings, 'PUSHWOOSH_API_URL', stub.url):
+                response = send_push_notification(self.receiver, "Hello")
+                self.assertEqual(response["status_code"], 200)
+                send_push_notification(self.receiver, "Hello again")
+
+        self.assertEqual(len(stub.requests), 4)
+        self.assertEqual(stub.requests[0]["path"], "/json/1.3/createMessage")
+        self.assertEqual(stub.requests[0]["body"]["request"]["notifications"][0]["devices"], ["ABC123"])
+        self.assertEqual(stub.requests[3]["body"]["request"]["notifications"][0]["content"], "Hello again")
+        self.assertEqual(len({request["port"] for request in stub.requests}), 1)
+
+        # Errors are returned once the retries run out
+        with PushwooshStubServer(statuses=[503] * 5) as stub:
+            with mock.patch.object(yak_settings, 'PUSHWOOSH_API_URL', stub.url), \
+                    mock.patch.object(yak_settings, 'PUSHWOOSH_RETRIES', 1):
+                response = send_push_notification(self.receiver, "Hello")
+        self.assertEqual(response["status_code"], 503)
+        self.assertEqual(len(stub.requests), 2)
+
+        # Other server errors may have sent the push already, so they aren't retried
+        with PushwooshStubServer(statuses=[500, 502, 504]) as stub:
+            with mock.patch.object(yak_settings, 'PUSHWOOSH_API_URL', stub.url):
+                response = send_push_notification(self.receiver, "Hello")
+        self.assertEqual(response["status_code"], 500)
+        self.assertEqual(len(stub.requests), 1)
+
+    @mock.patch.object(yak_settings, 'PUSHWOOSH_BATCH_SIZE', 3)
+    @mock.patch.object(yak_settings, 'PUSHWOOSH_BATCH_WINDOW', 0.5)
+    def test_pushwoosh_batching(self):
+        """
+        Pushes are sent in batches, either once the batch is full or at the end of the window, without holding up the
+        senders
+        """
+        def submit(request_data):
+            notifications = json.loads(request_data)["request"]["notifications"]
+            return {"status_code": 200, "response": {"Messages": [notification["content"] for notification in
+                                                                  notifications]}}
+        self.mock_submit_to_pushwoosh.side_effect = submit
+        self.addCleanup(pushwoosh_queue.flush)
+
+        start = time.monotonic()
+        results = [send_push_notification(self.receiver, "Push {}".format(index)) for index in range(4)]
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 1)
+        self.assertTrue(all(result.sent for result in results[:3]))
+        self.assertFalse(results[3].sent)
+
+        # The last push is sent at the end of the window
+        self.assertEqual(results[3].wait(timeout=5)["status_code"], 200)
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 2)
+        # Each push gets its own message code back
+        self.assertEqual([result.message_code for result in results], ["Push {}".format(index) for index in range(4)])
+
+    @mock.patch.object(yak_settings, 'PUSHWOOSH_BATCH_WINDOW', 0.05)
+    def test_pushwoosh_batch_errors_logged(self):
+        """
+        Errors sending a batch at the end of its window are logged, as there's no caller to raise them to
+        """
+        self.mock_submit_to_pushwoosh.side_effect = ConnectionError("Pushwoosh is down")
+        with self.assertLogs('yak.rest_notifications', level='ERROR') as logs:
+            result = send_push_notification(self.receiver, "Push")
+            self.assertIsNone(result.wait(timeout=5))
+        self.assertIn("Pushwoosh is down", logs.output[0])
+        self.assertIsInstance(result.error, ConnectionError)
+
+        with mock.patch.object(pushwoosh_queue, 'send_all', side_effect=ValueError("Can't send")):
+            with self.assertLogs('yak.rest_notifications', level='ERROR') as logs:
+                pushwoosh_queue.add({"content": "Push"})
+                pushwoosh_queue.timer.join(5)
+        self.assertIn("Can't send", logs.output[0])
+        self.assertFalse(pushwoosh_queue.pending)
+
     def test_push_notification_sent(self):
         message = "<h1>You have a notification!</h1>"
         response = send_push_notification(self.receiver, message)
@@ -78,6 +276,45 @@ class NotificationsTestCase(SchemaTestCase):
         response = send_push_notification(self.receiver, message)
         self.assertEqual(response["hello"], "world")
 
+        # Deep links are passed on to the handler
+        response = send_push_notification(self.receiver, message, deep_link="yak://posts/1")
+        self.assertEqual(response["deep_link"], "yak://posts/1")
+
+        # The handler is called for each receiver, with a result for each
+        responses = send_push_notifications([self.receiver, UserFactory()], message)
+        self.assertEqual(responses, [{"hello": "world", "deep_link": None}] * 2)
+
+    @mock.patch.object(yak_settings, 'PUSH_NOTIFICATION_BACKENDS', [
+        "yak.rest_notifications.utils.PushwooshPushBackend",
+        "yak.rest_notifications.utils.LoggingPushBackend",
+        "test_project.test_app.tests.test_notifications.MockPushBackend",
+    ])
+    def test_push_backends(self):
+        """
+        Every message is sent with each configured backend, and `send_many` sends many messages per request
+        """
+        MockPushBackend.sent = []
+        backends = push_backends.backends
+        self.assertIs(push_backends.backends, backends)
+
+        other_receiver = UserFactory()
+        messages = [PushMessage([self.receiver], "Hello", "yak://posts/1"),
+                    PushMessage([self.receiver, other_receiver], "Hello both", None)]
+        with self.assertLogs('yak.rest_notifications.push', level='INFO') as logs:
+            results = push_backends.send_many(messages)
+
+        # One result per receiver, shared by the receivers of each message
+        self.assertEqual(results, [{"status_code": 200}] * 3)
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 1)
+        notifications = json.loads(self.mock_submit_to_pushwoosh.call_args[0][0])["request"]["notifications"]
+        self.assertEqual([notification["content"] for notification in notifications], ["Hello", "Hello both"])
+        self.assertEqual(notifications[0]["link"], "yak://posts/1")
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(MockPushBackend.sent, messages)
+
+        send_push_notification(self.receiver, "Deep", deep_link="yak://posts/2")
+        self.assertEqual(MockPushBackend.sent[-1], PushMessage([self.receiver], "Deep", "yak://posts/2"))
+
     def test_create_notification(self):
         notification_count = Notification.objects.count()
 
@@ -89,6 +326,65 @@ class NotificationsTestCase(SchemaTestCase):
         create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
         self.assertEqual(notification_count + 1, Notification.objects.count())
 
+    @mock.patch.object(yak_settings, 'NOTIFICATION_AGGREGATION_WINDOW', 3600)
+    @mock.patch.object(yak_settings, 'NOTIFICATION_AGGREGATION_REPORTERS', 3)
+    def test_notification_aggregation(self):
+        """
+        Notifications about the same object within the window update one notification, which is pushed once
+        """
+        reporters = UserFactory.create_batch(4)
+        for reporter in reporters:
+            create_notification(self.receiver, reporter, self.social_obj, self.notification_type)
+        # The same reporter twice in a row isn't counted again
+        notification = create_notification(self.receiver, reporters[3], self.social_obj, self.notification_type)
+
+        self.assertEqual(Notification.objects.filter(user=self.receiver).count(), 1)
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(notification.count, 4)
+        self.assertEqual(notification.reporter, reporters[3])
+        self.assertEqual(set(notification.other_reporters.all()), {reporters[1], reporters[2]})
+
+        # Nor is one of the other reporters coming back
+        notification = create_notification(self.receiver, reporters[1], self.social_obj, self.notification_type)
+        self.assertEqual(notification.count, 4)
+        self.assertEqual(notification.reporter, reporters[3])
+
+        url = reverse("notifications")
+        response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
+        self.assertEqual(response.data['results'][0]['count'], 4)
+        self.assertEqual(len(response.data['results'][0]['other_reporters']), 2)
+
+        # Other objects and types, or notifications after the window, aren't aggregated
+        create_notification(self.receiver, reporters[0], PostFactory(), self.notification_type)
+        create_notification(self.receiver, reporters[0], self.social_obj, NotificationType.objects.get(slug="like"))
+        Notification.objects.filter(pk=notification.pk).update(created=timezone.now() - timedelta(hours=2))
+        create_notification(self.receiver, reporters[0], self.social_obj, self.notification_type)
+        self.assertEqual(Notification.objects.filter(user=self.receiver).count(), 4)
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 4)
+
+    @mock.patch.object(yak_settings, 'NOTIFICATION_AGGREGATION_WINDOW', 3600)
+    def test_aggregated_notification_moves_to_top(self):
+        """
+        Folding a notification into an older one brings that one back to the top of the inbox
+        """
+        reporters = UserFactory.create_batch(2)
+        aggregated = create_notification(self.receiver, reporters[0], self.social_obj, self.notification_type)
+        other = create_notification(self.receiver, reporters[0], PostFactory(), self.notification_type)
+        created = timezone.now() - timedelta(minutes=10)
+        Notification.objects.filter(pk=aggregated.pk).update(created=created, last_activity=created)
+
+        url = reverse("notifications")
+        response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
+        self.assertEqual([result['id'] for result in response.data['results']], [other.pk, aggregated.pk])
+
+        create_notification(self.receiver, reporters[1], self.social_obj, self.notification_type)
+        response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
+        self.assertEqual([result['id'] for result in response.data['results']], [aggregated.pk, other.pk])
+        self.assertEqual(response.data['results'][0]['count'], 2)
+        # The window stays anchored on when the notification was created
+        self.assertEqual(Notification.objects.get(pk=aggregated.pk).created, created)
+
     def test_correct_notification_type_sent(self):
         setting = NotificationSetting.objects.get(notification_type=self.notification_type,
                                                   user=self.receiver)
@@ -113,6 +409,54 @@ class NotificationsTestCase(SchemaTestCase):
         self.assertEqual(len(mail.outbox), 2)
         self.assertTrue(len(self.mock_submit_to_pushwoosh.mock_calls), 2)
 
+    @mock.patch.object(yak_settings, 'ASYNC_NOTIFICATIONS_EAGER', True)
+    @mock.patch.object(yak_settings, 'ASYNC_NOTIFICATIONS', True)
+    def test_create_notification_async_eager(self):
+        """
+        In eager mode, async notifications are created by the Celery task right away in this process
+        """
+        notification_count = Notification.objects.count()
+        create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        self.assertEqual(notification_count + 1, Notification.objects.count())
+        self.assertEqual(len(mail.outbox), 1)
+
+        other_receiver = UserFactory()
+        create_notifications([self.receiver, other_receiver, self.reporter], self.reporter, self.social_obj,
+                             self.notification_type)
+        self.assertEqual(notification_count + 3, Notification.objects.count())
+        self.assertEqual(len(mail.outbox), 3)
+
+        # `create_notification.delay` still works, from when `create_notification` was a task itself
+        create_notification.delay(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        self.assertEqual(notification_count + 4, Notification.objects.count())
+
+        # Receivers deleted before the task runs are skipped
+        receiver_id = other_receiver.pk
+        other_receiver.delete()
+        notification_count = Notification.objects.count()
+        content_type = ContentType.objects.get_for_model(Post)
+        create_notifications_task([receiver_id], self.reporter.pk, content_type.pk, self.social_obj.pk,
+                                  self.notification_type.pk)
+        self.assertEqual(notification_count, Notification.objects.count())
+
+    @mock.patch('yak.rest_notifications.models.transaction.on_commit', side_effect=lambda func: func())
+    @mock.patch('yak.rest_notifications.models.create_notification_task.apply_async')
+    @mock.patch.object(yak_settings, 'ASYNC_NOTIFICATIONS', True)
+    def test_create_notification_async(self, mock_apply_async, mock_on_commit):
+        """
+        Async notifications are queued by primary key once the transaction commits, instead of created in the request
+        """
+        notification_count = Notification.objects.count()
+        create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type,
+                            deep_link="yak://posts/1")
+        self.assertEqual(notification_count, Notification.objects.count())
+        self.assertEqual(len(mail.outbox), 0)
+
+        content_type = ContentType.objects.get_for_model(Post)
+        mock_apply_async.assert_called_once_with(args=(self.receiver.pk, self.reporter.pk, content_type.pk,
+                                                       self.social_obj.pk, self.notification_type.pk, None, None,
+                                                       "yak://posts/1"))
+
     def test_can_only_see_own_notifications(self):
         create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
         create_notification(self.reporter, self.receiver, self.social_obj, self.notification_type)
@@ -125,7 +469,216 @@ class NotificationsTestCase(SchemaTestCase):
 
         url = reverse("notifications")
         response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
-        self.assertEqual(response.data["count"], self.receiver.notifications_received.count())
+        self.assertEqual(len(response.data["results"]), self.receiver.notifications_received.count())
+
+    @mock.patch('yak.rest_notifications.models.transaction.on_commit', side_effect=lambda func: func())
+    def test_unread_notifications(self, mock_on_commit):
+        notifications = [create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+                         for _ in range(3)]
+        create_notification(self.reporter, self.receiver, self.social_obj, self.notification_type)
+
+        url = reverse("notifications_unread_count")
+        response = self.assertSchemaGet(url, None, "$notificationUnreadCountResponse", self.receiver)
+        self.assertEqual(response.data["count"], 3)
+
+        # The count is kept in the cache and incremented as notifications are created
+        create_notifications([self.receiver], self.reporter, self.social_obj, self.notification_type)
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_notification_counter.get(self.receiver.pk), 4)
+
+        url = reverse("notifications_mark_read")
+        data = {"ids": [notifications[0].pk, notifications[1].pk]}
+        response = self.assertSchemaPost(url, "$notificationMarkReadRequest", "$notificationMarkReadResponse", data,
+                                         self.receiver, status_OK=True)
+        self.assertEqual(response.data["marked_read"], 2)
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 2)
+        self.assertTrue(Notification.objects.get(pk=notifications[0].pk).is_read)
+
+        # Can't mark another user's notifications as read
+        other_notification = Notification.objects.get(user=self.reporter)
+        response = self.assertSchemaPost(url, "$notificationMarkReadRequest", "$notificationMarkReadResponse",
+                                         {"ids": [other_notification.pk]}, self.receiver, status_OK=True)
+        self.assertEqual(response.data["marked_read"], 0)
+        self.assertEqual(unread_notification_counter.get(self.reporter.pk), 1)
+
+        # Without ids, everything is marked as read
+        response = self.assertSchemaPost(url, "$notificationMarkReadRequest", "$notificationMarkReadResponse", {},
+                                         self.receiver, status_OK=True)
+        self.assertEqual(response.data["marked_read"], 2)
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 0)
+        self.assertFalse(Notification.objects.filter(user=self.receiver, is_read=False).exists())
+
+    @mock.patch('yak.rest_notifications.models.transaction.on_commit', side_effect=lambda func: func())
+    def test_unread_count_after_delete(self, mock_on_commit):
+        """
+        Deleting notifications, directly or along with the object they're about, updates the unread count
+        """
+        post = PostFactory()
+        create_notification(self.receiver, self.reporter, post, self.notification_type)
+        notification = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 3)
+
+        notification.delete()
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 2)
+
+        post.delete()
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 1)
+
+        # Read notifications don't count, so deleting them leaves the count cached
+        Notification.objects.filter(user=self.receiver).update(is_read=True)
+        unread_notification_counter.invalidate([self.receiver.pk])
+        self.assertEqual(unread_notification_counter.get(self.receiver.pk), 0)
+        Notification.objects.filter(user=self.receiver).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(unread_notification_counter.get(self.receiver.pk), 0)
+
+    @mock.patch('yak.rest_notifications.models.transaction.on_commit', side_effect=lambda func: func())
+    @mock.patch.object(yak_settings, 'NOTIFICATION_STREAM_HEARTBEAT', 0.05)
+    @mock.patch.object(yak_settings, 'NOTIFICATION_STREAM_TIMEOUT', 0.2)
+    def test_notification_stream(self, mock_on_commit):
+        seen = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        missed = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+
+        url = reverse("notifications_stream")
+        self.add_credentials(self.receiver)
+        response = self.client.get(url, HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID=str(seen.pk))
+        self.assertHttpOK(response)
+        self.assertEqual(response['Content-Type'], "text/event-stream")
+
+        # Published while the stream is open, and not for other users
+        created = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        create_notification(self.reporter, self.receiver, self.social_obj, self.notification_type)
+        events = b"".join(response.streaming_content).decode().split("\n\n")
+
+        # Notifications published before the stream caught up can be sent twice, clients replace them by id
+        notification_data = [json.loads(event.split("data: ")[1]) for event in events if "event: notification" in event]
+        self.assertEqual({data["id"] for data in notification_data}, {missed.pk, created.pk})
+        self.assertEqual(notification_data[0]["id"], missed.pk)
+        self.assertEqual(notification_data[-1]["id"], created.pk)
+        self.assertIn(": heartbeat", events)
+        self.assertEqual(get_notification_broker().subscriptions, {})
+
+        # Unauthenticated users can't stream
+        self.client.credentials()
+        response = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+        self.assertHttpUnauthorized(response)
+
+    @mock.patch.object(yak_settings, 'NOTIFICATION_LONG_POLL_TIMEOUT', 0.05)
+    def test_notification_long_poll(self):
+        notification = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+
+        url = reverse("notifications_stream")
+        response = self.assertSchemaGet(url, {"last_id": 0}, "$notificationResponse", self.receiver)
+        self.assertEqual([result["id"] for result in response.data["results"]], [notification.pk])
+        self.assertEqual(response.data["last_id"], notification.pk)
+
+        # Without new notifications, the request times out empty
+        response = self.client.get(url, {"last_id": notification.pk})
+        self.assertEqual(response.data, {"results": [], "last_id": notification.pk})
+
+        # Notifications published while waiting are returned, e.g. when others are aggregated into one already sent
+        with mock.patch.object(yak_settings, 'NOTIFICATION_LONG_POLL_TIMEOUT', 5):
+            timer = threading.Timer(0.05, get_notification_broker().publish, [self.receiver.pk, notification.pk])
+            timer.start()
+            response = self.client.get(url, {"last_id": notification.pk})
+            timer.join()
+        self.assertEqual([result["id"] for result in response.data["results"]], [notification.pk])
+
+        response = self.client.get(url, {"last_id": "abc"})
+        self.assertHttpBadRequest(response)
+
+    @mock.patch('yak.rest_notifications.models.transaction.on_commit', side_effect=lambda func: func())
+    def test_notification_long_poll_bulk_created(self, mock_on_commit):
+        """
+        Notifications inserted in bulk, which may not get their ids back, are announced to each receiver's stream
+        """
+        other_receiver = UserFactory()
+        published = []
+        get = InProcessSubscription.get
+
+        def create_while_waiting(subscription, timeout):
+            create_notifications([self.receiver, other_receiver], self.reporter, self.social_obj,
+                                 self.notification_type)
+            published.extend(get(subscription, timeout))
+            return published
+
+        url = reverse("notifications_stream")
+        with mock.patch.object(InProcessSubscription, 'get', autospec=True, side_effect=create_while_waiting):
+            response = self.assertSchemaGet(url, {"last_id": 0}, "$notificationResponse", self.receiver)
+        notification = Notification.objects.get(user=self.receiver)
+        self.assertEqual([result["id"] for result in response.data["results"]], [notification.pk])
+        self.assertEqual(response.data["last_id"], notification.pk)
+        # A single announcement for the receiver, without an id
+        self.assertEqual(published, [None])
+
+    def test_notification_pagination(self):
+        for _ in range(25):
+            create_notification(self.receiver, self.reporter, PostFactory(), self.notification_type)
+
+        url = reverse("notifications")
+        response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
+        self.assertEqual(len(response.data["results"]), settings.REST_FRAMEWORK['PAGE_SIZE'])
+        self.assertNotIn("count", response.data)
+        post_ids = [result["post"]["id"] for result in response.data["results"]]
+
+        response = self.assertSchemaGet(response.data["next"], None, "$notificationResponse", self.receiver)
+        self.assertIsNone(response.data["next"])
+        post_ids += [result["post"]["id"] for result in response.data["results"]]
+        # Newest first
+        self.assertEqual(post_ids, list(self.receiver.notifications_received.order_by("-created", "-id")
+                                        .values_list("object_id", flat=True)))
+
+    def test_notification_templates_loaded_once(self):
+        notification_renderer.clear()
+        for receiver in UserFactory.create_batch(3):
+            create_notification(receiver, self.reporter, self.social_obj, self.notification_type)
+        create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        create_notification(self.receiver, UserFactory(), self.social_obj, self.notification_type)
+
+        with mock.patch('yak.rest_notifications.utils.get_template') as mock_get_template:
+            notification = self.receiver.notifications_received.first()
+            self.assertEqual(notification.message(Notification.PUSH),
+                             notification_renderer.render(notification, Notification.PUSH))
+            self.assertFalse(mock_get_template.called)
+
+        url = reverse("notifications")
+        response = self.assertSchemaGet(url, None, "$notificationResponse", self.receiver)
+        messages = [notification.message(Notification.PUSH)
+                    for notification in self.receiver.notifications_received.order_by("-created")]
+        self.assertEqual([result["message"] for result in response.data["results"]], messages)
+
+    def test_notifications_query_count(self):
+        """
+        The number of queries for a page of notifications doesn't grow with the number of notifications
+        """
+        url = reverse("notifications")
+        self.add_credentials(self.receiver)
+
+        def add_notifications(count):
+            for _ in range(count):
+                create_notification(self.receiver, UserFactory(), PostFactory(), self.notification_type)
+                create_notification(self.receiver, UserFactory(), Article.objects.create(title="Article"),
+                                    self.notification_type)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertHttpOK(response)
+            return len(response.data["results"]), len(context.captured_queries)
+
+        add_notifications(1)
+        results, queries = count_queries()
+        self.assertEqual(results, 2)
+
+        add_notifications(9)
+        self.assertEqual(count_queries(), (20, queries))
+
+        response = self.client.get(url)
+        for result in response.data["results"]:
+            notification = self.receiver.notifications_received.get(reporter_id=result["reporter"]["id"])
+            key = notification.content_object._meta.model_name
+            self.assertEqual(result[key]["id"], notification.object_id)
 
     def test_content_object_serialization(self):
         """
@@ -138,7 +691,7 @@ class NotificationsTestCase(SchemaTestCase):
         create_notification(user, self.receiver, article, self.notification_type)
         url = reverse("notifications")
         response = self.assertSchemaGet(url, None, "$notificationResponse", user)
-        self.assertEqual(response.data["count"], 2)
+        self.assertEqual(len(response.data["results"]), 2)
         self.assertIn("article", response.data["results"][0])
         self.assertNotIn("post", response.data["results"][0])
         self.assertIn("post", response.data["results"][1])
@@ -191,6 +744,35 @@ class NotificationsTestCase(SchemaTestCase):
                                                          notification_type=share_type).count()
         self.assertEqual(notification_count, 1)
 
+    def test_share_with_many_users_sends_one_push(self):
+        """
+        Sharing with many users renders the message once and sends a single push request to all of their devices
+        """
+        receivers = [UserFactory() for _ in range(5)]
+        for receiver in receivers:
+            PushwooshToken.objects.create(user=receiver, token="token-{}".format(receiver.pk))
+
+        url = reverse("shares-list")
+        content_type = ContentType.objects.get_for_model(Post)
+        data = {
+            "content_type": content_type.pk,
+            "object_id": self.social_obj.pk,
+            "shared_with": [receiver.pk for receiver in receivers]
+        }
+        with mock.patch.object(notification_renderer, 'render', wraps=notification_renderer.render) as mock_render:
+            self.assertSchemaPost(url, "$shareRequest", "$shareResponse", data, self.reporter)
+        # One push message and one email message
+        self.assertEqual(mock_render.call_count, 2)
+
+        share_type = NotificationType.objects.get(slug="share")
+        self.assertEqual(Notification.objects.filter(user__in=receivers, notification_type=share_type).count(), 5)
+        self.assertEqual(len(mail.outbox), 5)
+
+        self.assertEqual(self.mock_submit_to_pushwoosh.call_count, 1)
+        request_data = json.loads(self.mock_submit_to_pushwoosh.call_args[0][0])
+        devices = request_data['request']['notifications'][0]['devices']
+        self.assertEqual(set(devices), {"token-{}".format(receiver.pk) for receiver in receivers})
+
     def test_like_creates_notification(self):
         url = reverse("likes-list")
         content_type = ContentType.objects.get_for_model(Post)
@@ -226,6 +808,29 @@ class NotificationsTestCase(SchemaTestCase):
 
         self.assertEqual(notification_count, 1)
 
+    def test_multiple_mentions_create_notifications(self):
+        """
+        Every mentioned user gets one notification, however many times they are mentioned
+        """
+        mentioned_users = [UserFactory() for _ in range(3)]
+        description = "@{0} @{1} @{2} @{0} @nobody".format(*[user.username for user in mentioned_users])
+        content_type = ContentType.objects.get_for_model(Post)
+
+        with CaptureQueriesContext(connection) as context:
+            Comment.objects.create(content_type=content_type, object_id=self.social_obj.pk, description=description,
+                                   user=self.reporter)
+        user_queries = [query for query in context.captured_queries
+                        if query['sql'].startswith('SELECT') and User._meta.db_table in query['sql'] and
+                        '"username" IN' in query['sql']]
+        self.assertEqual(len(user_queries), 1)
+
+        mention_type = NotificationType.objects.get(slug="mention")
+        for user in mentioned_users:
+            notifications = Notification.objects.filter(user=user, reporter=self.reporter,
+                                                        object_id=self.social_obj.pk, notification_type=mention_type)
+            self.assertEqual(notifications.count(), 1)
+        self.assertEqual(len(mail.outbox), 3)
+
     def test_serialization_when_content_object_deleted(self):
         mention_notification = NotificationType.objects.get(slug="mention")
         content_type = ContentType.objects.get_for_model(Post)
@@ -239,11 +844,76 @@ class NotificationsTestCase(SchemaTestCase):
                                     object_id=other_post.pk, user=user, reporter=self.reporter)
         url = reverse("notifications")
         response = self.assertSchemaGet(url, None, "$notificationResponse", user)
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['post']['id'], other_post.pk)
 
+    def test_prune_notifications_by_age(self):
+        for _ in range(5):
+            create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        recent = create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+        Notification.objects.exclude(pk=recent.pk).update(created=timezone.now() - timedelta(days=100))
+
+        out = StringIO()
+        call_command('prune_notifications', days=90, batch_size=2, dry_run=True, stdout=out)
+        self.assertIn("Would delete 5 notifications", out.getvalue())
+        self.assertEqual(Notification.objects.count(), 6)
+
+        out = StringIO()
+        call_command('prune_notifications', days=90, batch_size=2, stdout=out)
+        self.assertIn("Deleted 4 notifications so far", out.getvalue())
+        self.assertIn("Deleted 5 notifications\n", out.getvalue())
+        self.assertEqual(list(Notification.objects.values_list('pk', flat=True)), [recent.pk])
+
+    def test_prune_notifications_per_user(self):
+        other_receiver = UserFactory()
+        notifications = [create_notification(self.receiver, self.reporter, self.social_obj, self.notification_type)
+                         for _ in range(5)]
+        create_notification(other_receiver, self.reporter, self.social_obj, self.notification_type)
+        # Notifications created in the same instant are kept newest id first
+        Notification.objects.filter(pk__in=[notification.pk for notification in notifications[1:3]])\
+            .update(created=notifications[2].created)
+
+        call_command('prune_notifications', max_per_user=2, stdout=StringIO())
+        self.assertEqual(set(self.receiver.notifications_received.values_list('pk', flat=True)),
+                         {notifications[4].pk, notifications[3].pk})
+        self.assertEqual(other_receiver.notifications_received.count(), 1)
+
 
 class NotificationSettingsTestCase(SchemaTestCase):
+    def test_add_missing_notification_settings(self):
+        users = UserFactory.create_batch(5)
+        NotificationSetting.objects.filter(user__in=users[:3]).delete()
+        NotificationSetting.objects.filter(user=users[3], notification_type__slug="comment").delete()
+        missing = 3 * NotificationType.objects.count() + 1
+
+        out = StringIO()
+        call_command('add_missing_notification_settings', dry_run=True, stdout=out)
+        self.assertIn("Would create {} notification settings".format(missing), out.getvalue())
+        self.assertFalse(users[0].notification_settings.exists())
+
+        # Cached settings are invalidated once the new settings are committed
+        self.assertEqual(notification_settings_cache.get_many([users[0].pk]), {users[0].pk: {}})
+        out = StringIO()
+        with patch('yak.rest_notifications.management.commands.add_missing_notification_settings.transaction.on_commit',
+                   side_effect=lambda func: func()) as mock_on_commit:
+            call_command('add_missing_notification_settings', batch_size=2, stdout=out)
+        self.assertTrue(mock_on_commit.called)
+        self.assertIn("Created {} notification settings".format(missing), out.getvalue())
+        for user in users:
+            self.assertEqual(user.notification_settings.count(), NotificationType.objects.count())
+        self.assertEqual(len(notification_settings_cache.get_many([users[0].pk])[users[0].pk]),
+                         NotificationType.objects.count())
+
+        # One anti-join per type plus one insert (in a savepoint) per batch, not a query per user
+        NotificationSetting.objects.filter(user__in=users).delete()
+        with CaptureQueriesContext(connection) as context:
+            call_command('add_missing_notification_settings', stdout=StringIO())
+        self.assertLessEqual(len(context.captured_queries), 1 + 4 * NotificationType.objects.count())
+
+        out = StringIO()
+        call_command('add_missing_notification_settings', stdout=out)
+        self.assertIn("Created 0 notification settings", out.getvalue())
+
     def test_can_only_see_own_notification_settings(self):
         user = UserFactory()
         UserFactory()
@@ -301,3 +971,86 @@ class NotificationSettingsTestCase(SchemaTestCase):
 
         self.assertSchemaPut(url, "$notificationSettingBulkRequest", "$notificationSettingResponse", data, user)
         self.assertFalse(NotificationSetting.objects.get(pk=notification_settings[0].pk).allow_email)
+
+    @mock.patch.object(yak_settings, 'LAZY_NOTIFICATION_SETTINGS', True)
+    def test_lazy_notification_settings(self):
+        """
+        Settings are only saved once a user changes them, and the defaults apply until then
+        """
+        user = UserFactory()
+        reporter = UserFactory()
+        self.assertFalse(user.notification_settings.exists())
+        comment_type = NotificationType.objects.get(slug="comment")
+
+        with patch('yak.rest_notifications.utils.submit_to_pushwoosh'):
+            create_notification(user, reporter, PostFactory(), comment_type)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # Defaults are listed for every type
+        url = reverse("notification_settings-list")
+        response = self.assertSchemaGet(url, None, "$notificationSettingResponse", user)
+        self.assertEqual(response.data["count"], NotificationType.objects.count())
+        self.assertTrue(all(setting["id"] is None and setting["allow_email"] for setting in response.data["results"]))
+
+        data = [{"notification_type_id": comment_type.pk, "allow_email": False}]
+        self.assertSchemaPut(url, "$notificationSettingBulkRequest", "$notificationSettingResponse", data, user)
+        setting = user.notification_settings.get()
+        self.assertEqual(setting.notification_type, comment_type)
+        self.assertFalse(setting.allow_email)
+
+        # Saved settings are updated by id and merged with the defaults
+        data = [{"id": setting.pk, "allow_push": False}]
+        self.assertSchemaPut(url, "$notificationSettingBulkRequest", "$notificationSettingResponse", data, user)
+        response = self.assertSchemaGet(url, None, "$notificationSettingResponse", user)
+        self.assertEqual(response.data["count"], NotificationType.objects.count())
+        self.assertEqual([result for result in response.data["results"] if result["id"] == setting.pk][0]["allow_push"],
+                         False)
+        self.assertEqual(user.notification_settings.count(), 1)
+
+        with patch('yak.rest_notifications.utils.submit_to_pushwoosh') as mock_submit:
+            create_notification(user, reporter, PostFactory(), comment_type)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(mock_submit.called)
+
+    def test_notification_settings_cache(self):
+        user = UserFactory()
+        reporter = UserFactory()
+        comment_type = NotificationType.objects.get(slug="comment")
+        notification_settings_cache.reset_stats()
+
+        def settings_queries(context):
+            return [query for query in context.captured_queries
+                    if NotificationSetting._meta.db_table in query['sql']]
+
+        post = PostFactory()
+        with patch('yak.rest_notifications.utils.submit_to_pushwoosh'):
+            with CaptureQueriesContext(connection) as context:
+                create_notification(user, reporter, post, comment_type)
+            self.assertTrue(settings_queries(context))
+            with CaptureQueriesContext(connection) as context:
+                create_notification(user, reporter, post, comment_type)
+        self.assertFalse(settings_queries(context))
+        self.assertEqual(notification_settings_cache.stats(), {'hits': 1, 'misses': 1})
+        self.assertEqual(len(mail.outbox), 2)
+
+        # Saving a setting invalidates the user's cached settings
+        setting = user.notification_settings.get(notification_type=comment_type)
+        setting.allow_email = False
+        setting.save()
+        with patch('yak.rest_notifications.utils.submit_to_pushwoosh'):
+            with CaptureQueriesContext(connection) as context:
+                create_notification(user, reporter, PostFactory(), comment_type)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertTrue(settings_queries(context))
+        self.assertEqual(notification_settings_cache.stats()['misses'], 2)
+
+        # So do bulk updates
+        url = reverse("notification_settings-list")
+        data = [{"id": setting.pk, "allow_email": True}]
+        self.assertSchemaPut(url, "$notificationSettingBulkRequest", "$notificationSettingResponse", data, user)
+        with patch('yak.rest_notifications.utils.submit_to_pushwoosh'):
+            with CaptureQueriesContext(connection) as context:
+                create_notification(user, reporter, PostFactory(), comment_type)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertTrue(settings_queries(context))
+        self.assertEqual(notification_settings_cache.stats(), {'hits': 1, 'misses': 3})
@@ -1,12 +1,20 @@
+from io import StringIO
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError
+from django.test.utils import CaptureQueriesContext
 from rest_framework.reverse import reverse
 
 from test_project.test_app.models import Post
 from test_project.test_app.tests.factories import UserFactory, PostFactory, CommentFactory
 from yak.rest_core.test import SchemaTestCase
 from yak.rest_social_network.models import Follow, Comment, Tag, Like
+from yak.rest_user.views import UserViewSet
+from yak.rest_user.utils import get_user_content_type
 
 User = get_user_model()
 
@@ -79,6 +87,57 @@ class LikeTestCase(BaseAPITests):
         response = self.assertSchemaGet(url, None, "$postResponse", self.dev_user)
         self.assertIsNone(response.data["liked_id"])
 
+    def test_liked_mixin_list(self):
+        """
+        `liked_id` is resolved for a whole page of posts with a single query on likes
+        """
+        content_type = ContentType.objects.get_for_model(Post)
+        liked_posts = [PostFactory() for _ in range(3)]
+        unliked_posts = [PostFactory() for _ in range(3)]
+        likes = {post.pk: Like.objects.create(content_type=content_type, object_id=post.pk, user=self.dev_user).pk
+                 for post in liked_posts}
+        # Likes by other users don't count
+        Like.objects.create(content_type=content_type, object_id=unliked_posts[0].pk, user=UserFactory())
+
+        url = reverse("posts-list")
+        with CaptureQueriesContext(connection) as context:
+            response = self.assertSchemaGet(url, None, "$postResponse", self.dev_user)
+        like_queries = [query for query in context.captured_queries if Like._meta.db_table in query['sql']]
+        self.assertEqual(len(like_queries), 1)
+
+        results = {result["id"]: result["liked_id"] for result in response.data["results"]}
+        for post in liked_posts:
+            self.assertEqual(results[post.pk], likes[post.pk])
+        for post in unliked_posts:
+            self.assertIsNone(results[post.pk])
+
+    def test_like_count(self):
+        post = PostFactory()
+        content_type = ContentType.objects.get_for_model(Post)
+        like = Like.objects.create(content_type=content_type, object_id=post.pk, user=self.dev_user)
+        Like.objects.create(content_type=content_type, object_id=post.pk, user=UserFactory())
+
+        # Saving a stale instance doesn't overwrite the count
+        post.title = "New title"
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.likes_count(), 2)
+        self.assertEqual(post.title, "New title")
+
+        like.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.likes_count(), 1)
+
+        # A deleted instance is inserted again, with its counts
+        post.delete()
+        post.save()
+        self.assertTrue(Post.objects.filter(pk=post.pk, title="New title").exists())
+
+        # Saving an instance whose row was deleted elsewhere fails, as with explicit `update_fields`
+        Post.objects.filter(pk=post.pk).delete()
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            post.save()
+
 
 class CommentTestCase(BaseAPITests):
     def test_users_can_comment_on_content(self):
@@ -121,6 +180,66 @@ class CommentTestCase(BaseAPITests):
         self.assertEqual(len(response.data["results"]), 1)
         self.assertEqual(response.data["results"][0]["id"], comment.pk)
 
+    def test_comment_count(self):
+        post = PostFactory()
+        content_type = ContentType.objects.get_for_model(Post)
+        comment = CommentFactory(content_type=content_type, object_id=post.pk)
+        CommentFactory(content_type=content_type, object_id=post.pk)
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count(), 2)
+
+        comment.delete()
+        post.refresh_from_db()
+        self.assertEqual(post.comments_count(), 1)
+
+    def test_recalculate_social_counts(self):
+        post = PostFactory()
+        content_type = ContentType.objects.get_for_model(Post)
+        CommentFactory(content_type=content_type, object_id=post.pk)
+        Like.objects.create(content_type=content_type, object_id=post.pk, user=self.dev_user)
+        Post.objects.update(like_count=5, comment_count=0)
+
+        call_command('recalculate_social_counts', stdout=StringIO())
+        post.refresh_from_db()
+        self.assertEqual(post.likes_count(), 1)
+        self.assertEqual(post.comments_count(), 1)
+
+    def test_explain_social_queries(self):
+        post = PostFactory()
+        CommentFactory(content_type=ContentType.objects.get_for_model(Post), object_id=post.pk)
+        out = StringIO()
+        call_command('explain_social_queries', stdout=out)
+        self.assertIn('Comments on an object\n    ', out.getvalue())
+        self.assertIn('Notification inbox\n    ', out.getvalue())
+
+
+class TagTestCase(BaseAPITests):
+    def test_related_tags(self):
+        Tag.objects.create(name="existing")
+        post = PostFactory(description="#existing #new #new #another-one")
+        self.assertEqual(set(post.related_tags.values_list('name', flat=True)), {"existing", "new", "another-one"})
+        self.assertEqual(Tag.objects.filter(name="existing").count(), 1)
+
+        # Editing the tagged field relates new tags and keeps the old ones
+        post.description = "#existing #later"
+        post.save()
+        self.assertEqual(set(post.related_tags.values_list('name', flat=True)),
+                         {"existing", "new", "another-one", "later"})
+
+    def test_related_tags_query_count(self):
+        """
+        Relating tags takes a constant number of queries, however many tags there are
+        """
+        def count_tag_queries(description):
+            with CaptureQueriesContext(connection) as context:
+                PostFactory(user=self.dev_user, description=description)
+            return len([query for query in context.captured_queries if Tag._meta.db_table in query['sql']])
+
+        single_tag_queries = count_tag_queries("#one")
+        many_tag_queries = count_tag_queries(" ".join("#tag{}".format(i) for i in range(10)))
+        self.assertEqual(single_tag_queries, many_tag_queries)
+        self.assertEqual(Tag.objects.count(), 11)
+
 
 class UserFollowingTestCase(BaseAPITests):
     def test_user_can_follow_each_other(self):
@@ -144,8 +263,8 @@ class UserFollowingTestCase(BaseAPITests):
         Follow.objects.create(content_type=user_content_type, object_id=self.dev_user.pk, user=test_user2)
         following_url = reverse('users-following', args=[self.dev_user.pk])
         response = self.assertSchemaGet(following_url, None, "$followResponse", self.dev_user)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['following']['username'], test_user1.username)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['following']['username'], test_user1.username)
 
     def test_follower_endpoint(self):
         test_user1 = UserFactory()
@@ -156,8 +275,8 @@ class UserFollowingTestCase(BaseAPITests):
         Follow.objects.create(content_type=user_content_type, object_id=self.dev_user.pk, user=test_user2)
         followers_url = reverse('users-followers', args=[self.dev_user.pk])
         response = self.assertSchemaGet(followers_url, None, "$followResponse", self.dev_user)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]['follower']['username'], test_user2.username)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['follower']['username'], test_user2.username)
 
     def test_follow_pagination(self):
         user_content_type = ContentType.objects.get_for_model(User)
@@ -167,9 +286,55 @@ class UserFollowingTestCase(BaseAPITests):
 
         followers_url = reverse('users-followers', args=[self.dev_user.pk])
         response = self.assertSchemaGet(followers_url, None, "$followResponse", self.dev_user)
-        self.assertEqual(len(response.data), settings.REST_FRAMEWORK['PAGE_SIZE'])
-        response = self.assertSchemaGet(followers_url, {"page": 2}, "$followResponse", self.dev_user)
-        self.assertEqual(len(response.data), 30 - settings.REST_FRAMEWORK['PAGE_SIZE'])
+        self.assertEqual(len(response.data['results']), settings.REST_FRAMEWORK['PAGE_SIZE'])
+        self.assertNotIn('count', response.data)
+        first_page = [follow['id'] for follow in response.data['results']]
+
+        response = self.assertSchemaGet(response.data['next'], None, "$followResponse", self.dev_user)
+        self.assertEqual(len(response.data['results']), 30 - settings.REST_FRAMEWORK['PAGE_SIZE'])
+        self.assertIsNone(response.data['next'])
+        follows = first_page + [follow['id'] for follow in response.data['results']]
+        self.assertEqual(follows, list(self.dev_user.user_followers().order_by('created', 'id')
+                                       .values_list('id', flat=True)))
+
+    def test_follow_endpoints_query_count(self):
+        """
+        The number of queries for the following/followers endpoints doesn't grow with the number of follows
+        """
+        user_content_type = ContentType.objects.get_for_model(User)
+        followers_url = reverse('users-followers', args=[self.dev_user.pk])
+        following_url = reverse('users-following', args=[self.dev_user.pk])
+        self.add_credentials(self.dev_user)
+
+        def add_follows(count):
+            for _ in range(count):
+                user = UserFactory()
+                Follow.objects.create(content_type=user_content_type, object_id=self.dev_user.pk, user=user)
+                Follow.objects.create(content_type=user_content_type, object_id=user.pk, user=self.dev_user)
+
+        def count_queries(url):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertHttpOK(response)
+            return len(response.data['results']), len(context.captured_queries)
+
+        add_follows(2)
+        followers_results, followers_queries = count_queries(followers_url)
+        following_results, following_queries = count_queries(following_url)
+        self.assertEqual(followers_results, 2)
+        self.assertEqual(following_results, 2)
+
+        add_follows(8)
+        self.assertEqual(count_queries(followers_url), (10, followers_queries))
+        self.assertEqual(count_queries(following_url), (10, following_queries))
+
+    def test_user_content_type_cached(self):
+        self.assertEqual(get_user_content_type(), ContentType.objects.get_for_model(User))
+
+        # Building the follow querysets doesn't need to look up the user content type again
+        with self.assertNumQueries(0):
+            self.dev_user.user_following()
+            self.dev_user.user_followers()
 
     def test_user_can_unfollow_user(self):
         follower = UserFactory()
@@ -213,9 +378,74 @@ class UserFollowingTestCase(BaseAPITests):
             {'content_type': user_content_type.pk, 'object_id': user2.pk}
         ]
         self.assertSchemaPost(url, "$followRequest", "$followResponse", data, self.dev_user)
+        user1.refresh_from_db()
+        user2.refresh_from_db()
         self.assertEqual(user1.user_followers_count(), 1)
         self.assertEqual(user2.user_followers_count(), 1)
 
+    def test_follow_counts_updated_on_unfollow(self):
+        followed = UserFactory()
+        user_content_type = ContentType.objects.get_for_model(User)
+        follow = Follow.objects.create(content_type=user_content_type, object_id=followed.pk, user=self.dev_user)
+        # Following something other than a user doesn't change user follow counts
+        Follow.objects.create(content_type=ContentType.objects.get_for_model(Post), object_id=PostFactory().pk,
+                              user=self.dev_user)
+        self.dev_user.refresh_from_db()
+        followed.refresh_from_db()
+        self.assertEqual(self.dev_user.user_following_count(), 1)
+        self.assertEqual(followed.user_followers_count(), 1)
+
+        # Saving a stale instance doesn't overwrite the counts
+        stale_user = User.objects.get(pk=followed.pk)
+        stale_user.followers_count = 0
+        stale_user.save()
+        followed.refresh_from_db()
+        self.assertEqual(followed.user_followers_count(), 1)
+
+        follow.delete()
+        self.dev_user.refresh_from_db()
+        followed.refresh_from_db()
+        self.assertEqual(self.dev_user.user_following_count(), 0)
+        self.assertEqual(followed.user_followers_count(), 0)
+
+    def test_profile_update_keeps_follow_counts(self):
+        """
+        A profile PATCH that loaded the user before a follow was created doesn't write back the old counts
+        """
+        followed = UserFactory()
+        stale_user = User.objects.get(pk=followed.pk)
+        Follow.objects.create(content_type=get_user_content_type(), object_id=followed.pk, user=self.dev_user)
+
+        url = reverse("users-detail", args=[followed.pk])
+        with mock.patch.object(UserViewSet, 'get_object', return_value=stale_user):
+            self.assertSchemaPatch(url, "$userRequest", "$userResponse", {"fullname": "Hodor"}, followed)
+
+        followed.refresh_from_db()
+        self.assertEqual(followed.fullname, "Hodor")
+        self.assertEqual(followed.user_followers_count(), 1)
+
+        # Fields passed to `save` explicitly are the only ones written
+        stale_user.fullname = "Not saved"
+        stale_user.followers_count = 0
+        stale_user.save(update_fields=['followers_count'])
+        followed.refresh_from_db()
+        self.assertEqual(followed.fullname, "Hodor")
+        self.assertEqual(followed.user_followers_count(), 0)
+
+    def test_recalculate_follow_counts(self):
+        follower = UserFactory()
+        user_content_type = ContentType.objects.get_for_model(User)
+        Follow.objects.create(content_type=user_content_type, object_id=self.dev_user.pk, user=follower)
+        User.objects.update(following_count=0, followers_count=10)
+
+        call_command('recalculate_follow_counts', stdout=StringIO())
+        self.dev_user.refresh_from_db()
+        follower.refresh_from_db()
+        self.assertEqual(self.dev_user.user_followers_count(), 1)
+        self.assertEqual(self.dev_user.user_following_count(), 0)
+        self.assertEqual(follower.user_followers_count(), 0)
+        self.assertEqual(follower.user_following_count(), 1)
+
     def test_follow_id(self):
         follower = UserFactory()
         user_content_type = ContentType.objects.get_for_model(User)
@@ -228,3 +458,26 @@ class UserFollowingTestCase(BaseAPITests):
         url = reverse("users-detail", args=[self.dev_user.pk])
         response = self.assertSchemaGet(url, None, "$userResponse", not_follower)
         self.assertIsNone(response.data['follow_id'])
+
+    def test_follow_id_list(self):
+        """
+        `follow_id` is resolved for a whole page of users with a single query on follows
+        """
+        user_content_type = ContentType.objects.get_for_model(User)
+        followed_users = [UserFactory() for _ in range(3)]
+        follows = {user.pk: Follow.objects.create(content_type=user_content_type, object_id=user.pk,
+                                                  user=self.dev_user).pk
+                   for user in followed_users}
+        not_followed_user = UserFactory()
+
+        url = reverse("users-list")
+        with CaptureQueriesContext(connection) as context:
+            response = self.assertSchemaGet(url, None, "$userResponse", self.dev_user)
+        follow_id_queries = [query for query in context.captured_queries
+                             if Follow._meta.db_table in query['sql'] and '"object_id" IN' in query['sql']]
+        self.assertEqual(len(follow_id_queries), 1)
+
+        results = {result["id"]: result["follow_id"] for result in response.data["results"]}
+        for user in followed_users:
+            self.assertEqual(results[user.pk], follows[user.pk])
+        self.assertIsNone(results[not_followed_user.pk])
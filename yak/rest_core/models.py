@@ -19,6 +19,27 @@ class CoreModel(models.Model):
         abstract = True
 
 
+class CountFieldsMixin(object):
+    """
+    Leaves the model's `COUNT_FIELDS` out of the UPDATE when saving an existing instance. They are denormalized
+    counters only updated with `F()` expressions, so saving a stale instance mustn't overwrite them.
+
+    New instances, including deleted ones (whose pk `delete()` clears), are inserted with all their fields, and explicit
+    `update_fields` are written as given. As with any save with `update_fields`, saving an instance whose row was
+    deleted elsewhere raises `DatabaseError` instead of inserting it again.
+    """
+    COUNT_FIELDS = ()
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not force_insert and self.pk is not None and not self._state.adding:
+            deferred_fields = self.get_deferred_fields()
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in self.COUNT_FIELDS and
+                             field.attname not in deferred_fields]
+        return super(CountFieldsMixin, self).save(force_insert=force_insert, force_update=force_update, using=using,
+                                                  update_fields=update_fields)
+
+
 class Media(CoreModel):
     TYPE_CHOICES = Choices(
         (0, 'image', 'Image'),
@@ -0,0 +1,19 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreatedCursorPagination(CursorPagination):
+    """
+    Cursor pagination on (created, id), oldest first
+
+    Pages are fetched by filtering on the last `created` value seen instead of an OFFSET, and no COUNT(*) is run.
+    Clients follow the `next` and `previous` links; there is no random page access.
+    Views using an ordering filter should set `ordering` to the same value.
+    """
+    ordering = ('created', 'id')
+
+
+class NewestFirstCursorPagination(CreatedCursorPagination):
+    """
+    Cursor pagination on (created, id), newest first
+    """
+    ordering = ('-created', '-id')
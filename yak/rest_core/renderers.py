@@ -0,0 +1,30 @@
+import json
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets views accept `text/event-stream` (server-sent events) requests
+
+    Views stream the events themselves with a `StreamingHttpResponse`. Responses rendered here, e.g. errors, are sent as
+    a single `error` event.
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    @staticmethod
+    def event(data, event=None, event_id=None):
+        lines = []
+        if event_id is not None:
+            lines.append("id: {}".format(event_id))
+        if event is not None:
+            lines.append("event: {}".format(event))
+        lines.append("data: {}".format(json.dumps(data, cls=JSONEncoder)))
+        return "\n".join(lines) + "\n\n"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return self.event(data, event='error').encode(self.charset)
@@ -1,5 +1,69 @@
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import models
+from django.db.models import prefetch_related_objects
 from rest_framework import serializers
+from rest_framework.fields import get_attribute
+from rest_framework.serializers import LIST_SERIALIZER_KWARGS
+
+
+def prefetch_relation(instances, source_attrs):
+    """
+    Loads a forward foreign key for all the instances in one query, unless it was already loaded with select_related
+    """
+    if len(source_attrs) != 1 or not instances or not isinstance(instances[0], models.Model):
+        return
+    if len({type(instance) for instance in instances}) != 1:
+        return
+    try:
+        model_field = instances[0]._meta.get_field(source_attrs[0])
+    except FieldDoesNotExist:
+        return
+    if model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+        prefetch_related_objects(instances, source_attrs[0])
+
+
+def prefetch_page(serializer, instances):
+    """
+    Calls the `prefetch_<field_name>` method (if any) for every field on `serializer` with the list of instances
+
+    Nested serializers are handled the same way, with the list of related objects they will serialize. Foreign keys
+    for nested serializers are loaded for the whole list at once.
+    """
+    for field_name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+
+        prefetch_method = getattr(serializer, 'prefetch_{}'.format(field_name), None)
+        if prefetch_method is not None:
+            prefetch_method(instances)
+        elif isinstance(field, serializers.BaseSerializer) and not isinstance(field, serializers.ListSerializer):
+            prefetch_relation(instances, field.source_attrs)
+            related_instances = []
+            for instance in instances:
+                try:
+                    related_instance = get_attribute(instance, field.source_attrs)
+                except (KeyError, AttributeError, ObjectDoesNotExist):
+                    continue
+                if related_instance is not None:
+                    related_instances.append(related_instance)
+            if related_instances:
+                prefetch_page(field, related_instances)
+
+
+class YAKListSerializer(serializers.ListSerializer):
+    """
+    Lets the child serializer look up data for a whole page of objects at once instead of once per object
+
+    For every field on the child serializer, a matching `prefetch_<field_name>` method on the child (if any) is called
+    with the list of instances before they are serialized
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        instances = list(iterable)
+        prefetch_page(self.child, instances)
+        return super(YAKListSerializer, self).to_representation(instances)
 
 
 class YAKModelSerializer(serializers.ModelSerializer):
@@ -8,5 +72,22 @@ class YAKModelSerializer(serializers.ModelSerializer):
         super(YAKModelSerializer, self).__init__(*args, **kwargs)
         self.fields['content_type'] = serializers.SerializerMethodField()
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        """
+        Same as DRF's implementation, but defaults to `YAKListSerializer` if `list_serializer_class` isn't set on Meta
+        """
+        allow_empty = kwargs.pop('allow_empty', None)
+        child_serializer = cls(*args, **kwargs)
+        list_kwargs = {
+            'child': child_serializer,
+        }
+        if allow_empty is not None:
+            list_kwargs['allow_empty'] = allow_empty
+        list_kwargs.update({key: value for key, value in kwargs.items() if key in LIST_SERIALIZER_KWARGS})
+        meta = getattr(cls, 'Meta', None)
+        list_serializer_class = getattr(meta, 'list_serializer_class', YAKListSerializer)
+        return list_serializer_class(*args, **list_kwargs)
+
     def get_content_type(self, obj):
         return ContentType.objects.get_for_model(obj).pk
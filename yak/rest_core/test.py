@@ -3,6 +3,7 @@ import json
 from flake8.api.legacy import get_style_guide
 from rest_framework.test import APITestCase
 from django.conf import settings
+from django.core.cache import cache
 from yak.settings import yak_settings
 from django.test import TestCase
 import sys
@@ -138,6 +139,8 @@ class APITestCaseWithAssertions(APITestCase):
 class SchemaTestCase(APITestCaseWithAssertions):
     def setUp(self):
         super(SchemaTestCase, self).setUp()
+        # Ids are reused once each test's transaction is rolled back, so cached data would leak between tests
+        cache.clear()
 
         # Parse schema objects for use later
         self.schema_objects = {}
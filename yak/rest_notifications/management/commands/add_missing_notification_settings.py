@@ -1,6 +1,8 @@
 from django.contrib.auth import get_user_model
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction, IntegrityError
 from yak.rest_notifications.models import NotificationSetting, NotificationType
+from yak.rest_notifications.utils import notification_settings_cache
 
 __author__ = 'rudolphmutter'
 
@@ -12,7 +14,56 @@ class Command(BaseCommand):
     args = ''
     help = 'Creates missing notification settings for existing users'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of settings inserted per query (default 1000)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many settings are missing')
+
     def handle(self, *args, **options):
-        for user in User.objects.all():
-            for notification_type in NotificationType.objects.all():
-                NotificationSetting.objects.get_or_create(notification_type=notification_type, user=user)
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        total = 0
+        for notification_type in NotificationType.objects.all():
+            # Users without a setting for this type, found with a single anti-join
+            missing_users = User.objects.exclude(
+                pk__in=NotificationSetting.objects.filter(notification_type=notification_type).values('user')
+            ).order_by('pk').values_list('pk', flat=True)
+
+            if options['dry_run']:
+                count = missing_users.count()
+            else:
+                count = 0
+                batch = []
+                for user_id in missing_users.iterator():
+                    batch.append(user_id)
+                    if len(batch) == options['batch_size']:
+                        count += self.create_settings(notification_type, batch)
+                        batch = []
+                if batch:
+                    count += self.create_settings(notification_type, batch)
+
+            total += count
+            self.stdout.write("{}: {} missing settings".format(notification_type.slug, count))
+
+        verb = "Would create" if options['dry_run'] else "Created"
+        self.stdout.write("{} {} notification settings".format(verb, total))
+
+    def create_settings(self, notification_type, user_ids):
+        try:
+            with transaction.atomic():
+                NotificationSetting.objects.bulk_create(
+                    [NotificationSetting(notification_type=notification_type, user_id=user_id) for user_id in user_ids]
+                )
+            created = len(user_ids)
+        except IntegrityError:
+            # Some of the settings were created concurrently (e.g., by a new user signing up)
+            created = 0
+            for user_id in user_ids:
+                created += NotificationSetting.objects.get_or_create(notification_type=notification_type,
+                                                                     user_id=user_id)[1]
+
+        # bulk_create doesn't send the signals that keep the cache current. Invalidating once the settings are
+        # committed keeps concurrent reads from caching the settings as they were before the insert
+        transaction.on_commit(lambda: notification_settings_cache.invalidate(user_ids))
+        return created
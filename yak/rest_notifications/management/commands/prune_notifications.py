@@ -0,0 +1,74 @@
+from datetime import timedelta
+from django.core import serializers
+from django.core.management import BaseCommand, CommandError
+from django.db.models import Count, Q
+from django.utils import timezone
+from yak.rest_notifications.models import Notification
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Deletes notifications older than a number of days or beyond a per-user cap, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Delete notifications created more than this many days ago')
+        parser.add_argument('--max-per-user', type=int,
+                            help='Delete all but the newest notifications of each user beyond this number')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of notifications deleted per query (default 1000)')
+        parser.add_argument('--archive',
+                            help='Append the deleted notifications to this file, one JSON array per batch')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many notifications would be deleted')
+
+    def handle(self, *args, **options):
+        if options['days'] is None and options['max_per_user'] is None:
+            raise CommandError("Pass --days and/or --max-per-user")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        self.batch_size = options['batch_size']
+        self.archive = options['archive']
+        self.dry_run = options['dry_run']
+        self.deleted = 0
+
+        if options['days'] is not None:
+            cutoff = timezone.now() - timedelta(days=options['days'])
+            self.delete_in_batches(Notification.objects.filter(created__lt=cutoff))
+
+        if options['max_per_user'] is not None:
+            self.delete_beyond_cap(options['max_per_user'])
+
+        verb = "Would delete" if self.dry_run else "Deleted"
+        self.stdout.write("{} {} notifications".format(verb, self.deleted))
+
+    def delete_beyond_cap(self, max_per_user):
+        users = Notification.objects.order_by().values('user').annotate(count=Count('pk'))\
+            .filter(count__gt=max_per_user).values_list('user', flat=True)
+        for user_id in users.iterator():
+            user_notifications = Notification.objects.filter(user_id=user_id)
+            # The newest notification past the cap; it and everything older is removed
+            created, pk = user_notifications.order_by('-created', '-pk').values_list('created', 'pk')[max_per_user]
+            self.delete_in_batches(user_notifications.filter(
+                Q(created__lt=created) | Q(created=created, pk__lte=pk)))
+
+    def delete_in_batches(self, queryset):
+        if self.dry_run:
+            self.deleted += queryset.count()
+            return
+
+        while True:
+            batch = list(queryset.order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+            if not batch:
+                return
+
+            batch_queryset = Notification.objects.filter(pk__in=batch)
+            if self.archive:
+                with open(self.archive, 'a') as archive:
+                    archive.write(serializers.serialize('json', batch_queryset))
+                    archive.write('\n')
+            # Deleting unread notifications invalidates their users' cached unread counts
+            batch_queryset.delete()
+
+            self.deleted += len(batch)
+            self.stdout.write("Deleted {} notifications so far".format(self.deleted))
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.13 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_notifications', '0007_auto_20180320_2130'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'created', 'id'], name='rest_notifi_user_id_9eb0e7_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.13 on 2026-10-18 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_notifications', '0008_notification_cursor_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['content_type', 'object_id'], name='rest_notifi_content_f9c00b_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.0.13 on 2026-10-18 17:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('rest_notifications', '0009_notification_content_object_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='other_reporters',
+            field=models.ManyToManyField(blank=True, related_name='_notification_other_reporters_+', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
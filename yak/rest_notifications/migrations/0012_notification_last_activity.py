@@ -0,0 +1,30 @@
+# Generated by Django 2.0.13 on 2026-10-18 17:57
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def copy_created(apps, schema_editor):
+    Notification = apps.get_model("rest_notifications", "Notification")
+    Notification.objects.filter(created__isnull=False).update(last_activity=F('created'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_notifications', '0011_notification_is_read'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='last_activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(copy_created, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['user', 'last_activity', 'id'], name='rest_notifi_user_id_c50385_idx'),
+        ),
+    ]
@@ -1,11 +1,15 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from datetime import timedelta
 from caching.base import CachingMixin, CachingManager
 from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
-from django.db import models
-from django.template.loader import render_to_string
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
 from celery.task import task
 from yak.rest_core.models import CoreModel
 from yak.settings import yak_settings
@@ -45,6 +49,10 @@ def create_notification_settings(sender, **kwargs):
     if sender_name.lower() != settings.AUTH_USER_MODEL.lower():
         return
 
+    # Settings are only saved once a user changes them
+    if yak_settings.LAZY_NOTIFICATION_SETTINGS:
+        return
+
     if kwargs['created']:
         user = kwargs['instance']
         if not user.notification_settings.exists():
@@ -53,6 +61,40 @@ def create_notification_settings(sender, **kwargs):
                 user_settings.append(NotificationSetting(user=user, notification_type=notification_type))
             NotificationSetting.objects.bulk_create(user_settings)
 
+            from .utils import notification_settings_cache
+            notification_settings_cache.invalidate([user.pk])
+
+
+def get_notification_settings(users, notification_type):
+    """
+    Returns the users' settings for `notification_type`, keyed by user id, read through `notification_settings_cache`
+    The settings returned are unsaved `NotificationSetting` instances carrying the saved values
+
+    With `LAZY_NOTIFICATION_SETTINGS`, users without a saved setting get the default values
+    """
+    from .utils import notification_settings_cache
+    user_settings = notification_settings_cache.get_many([user.pk for user in users])
+
+    notification_settings = {}
+    for user in users:
+        values = user_settings[user.pk].get(notification_type.pk)
+        if values is None and not yak_settings.LAZY_NOTIFICATION_SETTINGS:
+            continue
+        setting = NotificationSetting(user=user, notification_type=notification_type)
+        if values is not None:
+            setting.allow_push, setting.allow_email = values
+        notification_settings[user.pk] = setting
+    return notification_settings
+
+
+def invalidate_notification_settings(sender, instance, **kwargs):
+    from .utils import notification_settings_cache
+    notification_settings_cache.invalidate([instance.user_id])
+
+
+post_save.connect(invalidate_notification_settings, sender=NotificationSetting)
+post_delete.connect(invalidate_notification_settings, sender=NotificationSetting)
+
 
 class Notification(CoreModel):
     PUSH = "push"
@@ -72,12 +114,19 @@ class Notification(CoreModel):
     object_id = models.PositiveIntegerField(db_index=True)
     content_object = GenericForeignKey()
 
-    def message(self, location):
+    # Set on notifications that others were folded into (see `NOTIFICATION_AGGREGATION_WINDOW`). `reporter` is then the
+    # latest reporter and `other_reporters` the ones before it, up to `NOTIFICATION_AGGREGATION_REPORTERS` in total
+    count = models.PositiveIntegerField(default=1)
+    other_reporters = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="+", blank=True)
+    # When a notification was last folded in (or `created`), which orders the inbox. `created` never changes.
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    is_read = models.BooleanField(default=False)
+
+    def message_context(self):
         """
-        Takes our configured notifications and creates a message
-        replacing the appropriate variables from the content object
+        Variables available to the notification's message template
         """
-
         data = defaultdict(str)
         # get the domain from Site
         data['domain'] = Site.objects.get_current().domain
@@ -86,13 +135,24 @@ class Notification(CoreModel):
             data['identifier'] = self.content_object.identifier()
         if self.reporter:
             data['reporter'] = self.reporter.identifier()
+        data['count'] = self.count
+        data['others'] = self.count - 1
 
         if hasattr(self.content_object, 'extra_notification_params'):
             data.update(self.content_object.extra_notification_params())
+        return data
 
+    def message_template_name(self):
         configured_template_name = "{}.html".format(self.notification_type.slug)
-        template_name = self.template_override if self.template_override else configured_template_name
-        return render_to_string("notifications/{}/{}".format(location, template_name), data)
+        return self.template_override if self.template_override else configured_template_name
+
+    def message(self, location):
+        """
+        Takes our configured notifications and creates a message
+        replacing the appropriate variables from the content object
+        """
+        from .utils import notification_renderer
+        return notification_renderer.render(self, location)
 
     def email_message(self):
         return self.message(Notification.EMAIL)
@@ -113,16 +173,100 @@ class Notification(CoreModel):
 
     class Meta:
         ordering = ['-created']
+        indexes = [
+            models.Index(fields=['user', 'created', 'id']),
+            models.Index(fields=['user', 'last_activity', 'id']),
+            models.Index(fields=['content_type', 'object_id']),
+            models.Index(fields=['user', 'is_read']),
+        ]
+
+
+def invalidate_unread_notification_count(sender, instance, **kwargs):
+    """
+    Deleting an unread notification, directly or along with its user or content object, changes the user's count
+    """
+    if not instance.is_read:
+        from .utils import unread_notification_counter
+        transaction.on_commit(lambda: unread_notification_counter.invalidate([instance.user_id]))
+
+
+post_delete.connect(invalidate_unread_notification_count, sender=Notification)
+
+
+def send_notification(notification, notification_setting, reply_to=None):
+    """
+    Delivers an already created notification by push and/or email, as allowed by the receiver's setting
+    """
+    receiver = notification.user
+    if notification_setting.allow_push and yak_settings.ALLOW_PUSH:
+        from .utils import send_push_notification
+        send_push_notification(receiver, notification.push_message(), deep_link=notification.deep_link)
+
+    if notification_setting.allow_email and yak_settings.ALLOW_EMAIL and receiver.email:
+        from .utils import send_email_notification
+        send_email_notification(receiver, notification.email_message(), reply_to=reply_to)
+
+
+def dispatch_notification_task(notification_task, *args):
+    """
+    Runs a notification task through Celery. Arguments must be primary keys or other plain values.
+
+    If `ASYNC_NOTIFICATIONS_EAGER` is set, the task runs right away in this process. Otherwise it is sent to the
+    broker once the current transaction commits, so the worker can see the objects it refers to.
+    """
+    if yak_settings.ASYNC_NOTIFICATIONS_EAGER:
+        return notification_task.apply(args=args, throw=True)
+
+    transaction.on_commit(lambda: notification_task.apply_async(args=args))
 
 
-@task
 def create_notification(receiver, reporter, content_object, notification_type, template_override=None, reply_to=None,
                         deep_link=None):
+    """
+    Creates a notification for `receiver` and sends it by push and/or email
+
+    If `ASYNC_NOTIFICATIONS` is set, this is done by a Celery worker instead of in the current request
+    """
     # If the receiver of this notification is the same as the reporter or
     # if the user has blocked this type, then don't create
     if receiver == reporter:
         return
 
+    if yak_settings.ASYNC_NOTIFICATIONS:
+        delay_create_notification(receiver, reporter, content_object, notification_type,
+                                  template_override=template_override, reply_to=reply_to, deep_link=deep_link)
+        return
+
+    return _create_notification(receiver, reporter, content_object, notification_type,
+                                template_override=template_override, reply_to=reply_to, deep_link=deep_link)
+
+
+def delay_create_notification(receiver, reporter, content_object, notification_type, template_override=None,
+                              reply_to=None, deep_link=None):
+    """
+    Has a Celery worker create the notification, whether or not `ASYNC_NOTIFICATIONS` is set
+
+    Also available as `create_notification.delay`, from when `create_notification` itself was a Celery task
+    """
+    if receiver == reporter:
+        return
+
+    content_type = ContentType.objects.get_for_model(content_object)
+    dispatch_notification_task(create_notification_task, receiver.pk, reporter.pk if reporter else None,
+                               content_type.pk, content_object.pk, notification_type.pk, template_override,
+                               reply_to, deep_link)
+
+
+create_notification.delay = delay_create_notification
+
+
+def _create_notification(receiver, reporter, content_object, notification_type, template_override=None,
+                         reply_to=None, deep_link=None):
+    if yak_settings.NOTIFICATION_AGGREGATION_WINDOW:
+        notification = aggregate_notification(receiver, reporter, content_object, notification_type)
+        if notification is not None:
+            return notification
+
     notification = Notification.objects.create(user=receiver,
                                                reporter=reporter,
                                                content_object=content_object,
@@ -131,14 +275,181 @@ def create_notification(receiver, reporter, content_object, notification_type, t
                                                deep_link=deep_link)
     notification.save()
 
-    notification_setting = NotificationSetting.objects.get(notification_type=notification_type, user=receiver)
-    if notification_setting.allow_push and yak_settings.ALLOW_PUSH:
-        from .utils import send_push_notification
-        send_push_notification(receiver, notification.push_message(), deep_link=deep_link)
+    from .utils import unread_notification_counter
+    transaction.on_commit(lambda: unread_notification_counter.increment([receiver.pk]))
+    publish_notifications([notification])
+
+    notification_setting = get_notification_settings([receiver], notification_type).get(receiver.pk)
+    if notification_setting is not None:
+        send_notification(notification, notification_setting, reply_to=reply_to)
+    return notification
+
+
+def aggregate_notification(receiver, reporter, content_object, notification_type):
+    """
+    Folds a new notification into the receiver's latest one of the same type about the same object, if that one was
+    created less than `NOTIFICATION_AGGREGATION_WINDOW` seconds ago. Returns the updated notification, or None if
+    there was nothing to fold it into.
+
+    Only the notification that starts a window is pushed or emailed, so the receiver hears about an object at most
+    once per window whatever the number of reporters. Folding in a notification bumps `last_activity`, bringing the
+    notification back to the top of the inbox. A notification that was already read becomes unread again.
+
+    Reporters already on the notification aren't counted again. Only the `NOTIFICATION_AGGREGATION_REPORTERS` latest
+    are kept though, so an earlier reporter coming back after many others is.
+    """
+    content_type = ContentType.objects.get_for_model(content_object)
+    window_start = timezone.now() - timedelta(seconds=yak_settings.NOTIFICATION_AGGREGATION_WINDOW)
+    reporter_id = reporter.pk if reporter else None
+    with transaction.atomic():
+        notification = Notification.objects.select_for_update().filter(
+            user=receiver, notification_type=notification_type, content_type=content_type,
+            object_id=content_object.pk, created__gte=window_start
+        ).order_by('-created', '-id').first()
+        if notification is None:
+            return None
+
+        # E.g. liking, unliking and liking again
+        if notification.reporter_id == reporter_id or (
+                reporter_id and notification.other_reporters.filter(pk=reporter_id).exists()):
+            return notification
+
+        Notification.objects.filter(pk=notification.pk).update(count=F('count') + 1, reporter=reporter, is_read=False,
+                                                               last_activity=timezone.now())
+        if notification.is_read:
+            from .utils import unread_notification_counter
+            transaction.on_commit(lambda: unread_notification_counter.increment([receiver.pk]))
+        if notification.reporter_id:
+            through = Notification.other_reporters.through
+            through.objects.create(notification=notification, user_id=notification.reporter_id)
+            stale_ids = through.objects.filter(notification=notification).order_by('-id').values_list(
+                'id', flat=True)[max(yak_settings.NOTIFICATION_AGGREGATION_REPORTERS - 1, 0):]
+            through.objects.filter(id__in=list(stale_ids)).delete()
+
+    notification.refresh_from_db()
+    publish_notifications([notification], updated=True)
+    return notification
+
+
+def publish_notifications(notifications, updated=False):
+    """
+    Announces the notifications on their receivers' notification streams, once the current transaction commits so the
+    streams can load them
+
+    Streams load new notifications past the last id they sent, so only their receivers are announced (notifications
+    inserted in bulk may not even have their ids). Notifications `updated` by aggregation may have been sent already,
+    so their ids are announced for the streams to send them again.
+    """
+    from .utils import get_notification_broker
+    if updated:
+        messages = [(notification.user_id, notification.pk) for notification in notifications]
+    else:
+        user_ids = OrderedDict.fromkeys(notification.user_id for notification in notifications)
+        messages = [(user_id, None) for user_id in user_ids]
+    transaction.on_commit(lambda: get_notification_broker().publish_many(messages))
+
+
+def create_notifications(receivers, reporter, content_object, notification_type, template_override=None,
+                         reply_to=None, deep_link=None):
+    """
+    Same as `create_notification`, but for many receivers of the same notification at once
+    Notifications are inserted in bulk and the receivers' settings are loaded with a single query. They are never
+    aggregated, since each receiver was picked out individually (shares and mentions).
+    """
+    receivers = [receiver for receiver in receivers if receiver != reporter]
+    if not receivers:
+        return []
+
+    if yak_settings.ASYNC_NOTIFICATIONS:
+        content_type = ContentType.objects.get_for_model(content_object)
+        dispatch_notification_task(create_notifications_task, [receiver.pk for receiver in receivers],
+                                   reporter.pk if reporter else None, content_type.pk, content_object.pk,
+                                   notification_type.pk, template_override, reply_to, deep_link)
+        return []
+
+    return _create_notifications(receivers, reporter, content_object, notification_type,
+                                 template_override=template_override, reply_to=reply_to, deep_link=deep_link)
+
+
+def _create_notifications(receivers, reporter, content_object, notification_type, template_override=None,
+                          reply_to=None, deep_link=None):
+    # E.g. every receiver was deleted before the Celery task ran
+    if not receivers:
+        return []
+
+    content_type = ContentType.objects.get_for_model(content_object)
+    notifications = [Notification(user=receiver,
+                                  reporter=reporter,
+                                  content_type=content_type,
+                                  object_id=content_object.pk,
+                                  notification_type=notification_type,
+                                  template_override=template_override,
+                                  deep_link=deep_link) for receiver in receivers]
+    Notification.objects.bulk_create(notifications)
+
+    from .utils import unread_notification_counter
+    receiver_ids = [receiver.pk for receiver in receivers]
+    transaction.on_commit(lambda: unread_notification_counter.increment(receiver_ids))
+    publish_notifications(notifications)
+
+    settings_by_user = get_notification_settings(receivers, notification_type)
+    push_receivers = []
+    email_receivers = []
+    for notification in notifications:
+        notification_setting = settings_by_user.get(notification.user_id)
+        if notification_setting is None:
+            continue
+        if notification_setting.allow_push and yak_settings.ALLOW_PUSH:
+            push_receivers.append(notification.user)
+        if notification_setting.allow_email and yak_settings.ALLOW_EMAIL and notification.user.email:
+            email_receivers.append(notification.user)
+
+    # The message is the same for every receiver, so it only needs to be rendered once
+    notification = notifications[0]
+    notification.content_object = content_object
+    if push_receivers:
+        from .utils import send_push_notifications
+        send_push_notifications(push_receivers, notification.push_message(), deep_link=deep_link)
+
+    if email_receivers:
+        from .utils import send_email_notifications
+        send_email_notifications(email_receivers, notification.email_message(), reply_to=reply_to)
+
+    return notifications
 
-    if notification_setting.allow_email and yak_settings.ALLOW_EMAIL and receiver.email:
-        from .utils import send_email_notification
-        send_email_notification(receiver, notification.email_message(), reply_to=reply_to)
+
+@task
+def create_notification_task(receiver_id, reporter_id, content_type_id, object_id, notification_type_id,
+                             template_override=None, reply_to=None, deep_link=None):
+    """
+    Celery task behind `create_notification` when `ASYNC_NOTIFICATIONS` is set
+    """
+    User = get_user_model()
+    content_object = ContentType.objects.get_for_id(content_type_id).get_object_for_this_type(pk=object_id)
+    _create_notification(User.objects.get(pk=receiver_id),
+                         User.objects.get(pk=reporter_id) if reporter_id else None,
+                         content_object,
+                         NotificationType.objects.get(pk=notification_type_id),
+                         template_override=template_override,
+                         reply_to=reply_to,
+                         deep_link=deep_link)
+
+
+@task
+def create_notifications_task(receiver_ids, reporter_id, content_type_id, object_id, notification_type_id,
+                              template_override=None, reply_to=None, deep_link=None):
+    """
+    Celery task behind `create_notifications` when `ASYNC_NOTIFICATIONS` is set
+    """
+    User = get_user_model()
+    content_object = ContentType.objects.get_for_id(content_type_id).get_object_for_this_type(pk=object_id)
+    _create_notifications(list(User.objects.filter(pk__in=receiver_ids)),
+                          User.objects.get(pk=reporter_id) if reporter_id else None,
+                          content_object,
+                          NotificationType.objects.get(pk=notification_type_id),
+                          template_override=template_override,
+                          reply_to=reply_to,
+                          deep_link=deep_link)
 
 
 class PushwooshToken(CoreModel):
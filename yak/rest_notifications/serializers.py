@@ -1,5 +1,8 @@
+from collections import defaultdict, OrderedDict
 from rest_framework import serializers
+from yak.rest_core.serializers import YAKListSerializer
 from yak.rest_notifications.models import NotificationSetting, Notification, PushwooshToken, NotificationType
+from yak.rest_notifications.utils import notification_renderer, notification_settings_cache
 from yak.rest_user.serializers import UserSerializer
 from yak.settings import yak_settings
 
@@ -28,8 +31,13 @@ class NotificationSettingListSerializer(serializers.ListSerializer):
     """
     def update(self, instance, validated_data):
         # Maps for id->instance and id->data item.
-        object_mapping = {obj.id: obj for obj in instance}
-        data_mapping = {item['id']: item for item in validated_data}
+        object_mapping = {obj.id: obj for obj in instance if obj.id is not None}
+        data_mapping = {item['id']: item for item in validated_data if 'id' in item}
+
+        # Settings that aren't saved yet (see `LAZY_NOTIFICATION_SETTINGS`) are identified by their type instead
+        type_mapping = {obj.notification_type_id: obj for obj in instance}
+        type_data_mapping = {item['notification_type_id']: item for item in validated_data
+                             if 'id' not in item and 'notification_type_id' in item}
 
         # Perform creations and updates.
         ret = []
@@ -40,6 +48,14 @@ class NotificationSettingListSerializer(serializers.ListSerializer):
             else:
                 ret.append(self.child.update(obj, data))
 
+        for notification_type_id, data in type_data_mapping.items():
+            obj = type_mapping.get(notification_type_id, None)
+            if obj is None:
+                raise serializers.ValidationError("Cannot update notification type {}".format(notification_type_id))
+            else:
+                ret.append(self.child.update(obj, data))
+
+        notification_settings_cache.invalidate({obj.user_id for obj in ret})
         return ret
 
 
@@ -47,26 +63,74 @@ class NotificationSettingSerializer(serializers.ModelSerializer):
     notification_type = NotificationTypeSerializer(read_only=True)
     # This allows us to pass `id` for bulk updates
     id = serializers.IntegerField(label='ID', read_only=False, required=False)
+    # Or the type, for settings that aren't saved yet
+    notification_type_id = serializers.IntegerField(write_only=True, required=False)
 
     class Meta:
         model = NotificationSetting
-        fields = ('id', 'notification_type', 'allow_push', 'allow_email')
+        fields = ('id', 'notification_type', 'notification_type_id', 'allow_push', 'allow_email')
         list_serializer_class = NotificationSettingListSerializer
 
+    def update(self, instance, validated_data):
+        # Only used to find the setting to update, the type of a setting can't change
+        validated_data.pop('notification_type_id', None)
+        return super(NotificationSettingSerializer, self).update(instance, validated_data)
+
+
+class MarkNotificationsReadSerializer(serializers.Serializer):
+    # Without ids, all of the user's notifications are marked as read
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False)
+
 
 class NotificationSerializer(serializers.ModelSerializer):
     message = serializers.SerializerMethodField()
     reporter = UserSerializer(read_only=True)
+    other_reporters = UserSerializer(read_only=True, many=True)
     content_object = serializers.SerializerMethodField()
 
     class Meta:
         model = Notification
-        fields = ('created', 'name', 'message', 'reporter', 'content_object')
+        fields = ('id', 'created', 'name', 'message', 'reporter', 'count', 'other_reporters', 'is_read',
+                  'content_object')
+        list_serializer_class = YAKListSerializer
+
+    def prefetch_message(self, instances):
+        """
+        Called by `YAKListSerializer` to render the messages for a whole page at once
+        """
+        messages = notification_renderer.render_many(instances, Notification.PUSH)
+        self._messages = {notification.pk: message for notification, message in zip(instances, messages)}
 
     def get_message(self, obj):
+        messages = getattr(self, '_messages', {})
+        if obj.pk in messages:
+            return messages[obj.pk]
         return obj.message(Notification.PUSH)
 
+    def prefetch_content_object(self, instances):
+        """
+        Called by `YAKListSerializer` to serialize the content objects for a whole page at once. Objects are serialized
+        as one list per content type, so the mapped serializers can prefetch their own nested data too.
+        """
+        content_objects = defaultdict(OrderedDict)
+        for notification in instances:
+            content_object = notification.content_object
+            if content_object is not None:
+                content_objects[type(content_object)][content_object.pk] = content_object
+
+        self._content_objects = {}
+        for model, objects in content_objects.items():
+            serializer_class = yak_settings.SERIALIZER_MAPPING[model]
+            serializer = serializer_class(list(objects.values()), many=True, context=self.context)
+            for pk, data in zip(objects, serializer.data):
+                self._content_objects[(model, pk)] = data
+
     def get_content_object(self, obj):
+        content_objects = getattr(self, '_content_objects', {})
+        key = (type(obj.content_object), obj.content_object.pk)
+        if key in content_objects:
+            return content_objects[key]
+
         serializer_class = yak_settings.SERIALIZER_MAPPING[type(obj.content_object)]
         serializer = serializer_class(instance=obj.content_object, context=self.context)
         return serializer.data
@@ -2,7 +2,7 @@ from django.conf.urls import url, include
 from rest_framework import routers
 from yak.rest_notifications.views import NotificationSettingViewSet, NotificationView, \
     NotificationFollowViewSet, NotificationLikeViewSet, NotificationShareViewSet, NotificationCommentViewSet, \
-    PushwooshTokenView
+    PushwooshTokenView, UnreadNotificationCountView, MarkNotificationsReadView, NotificationStreamView
 
 
 router = routers.DefaultRouter()
@@ -16,5 +16,8 @@ router.register(r'comments', NotificationCommentViewSet, base_name='comments')
 urlpatterns = [
     url(r'^', include(router.urls)),
     url(r'^notifications/$', NotificationView.as_view(), name="notifications"),
+    url(r'^notifications/unread_count/$', UnreadNotificationCountView.as_view(), name="notifications_unread_count"),
+    url(r'^notifications/mark_read/$', MarkNotificationsReadView.as_view(), name="notifications_mark_read"),
+    url(r'^notifications/stream/$', NotificationStreamView.as_view(), name="notifications_stream"),
     url(r'^pushwoosh_token/$', PushwooshTokenView.as_view(), name="pushwoosh_token"),
 ]
@@ -1,51 +1,537 @@
+import atexit
 import json
+import logging
+import queue
+import threading
+from collections import defaultdict, namedtuple, OrderedDict
 
 import requests
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
 from django.utils.html import strip_tags
 from django.utils.module_loading import import_string
 from pypushwoosh import constants
 from pypushwoosh.client import PushwooshClient
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
+from yak.rest_notifications.models import Notification, NotificationSetting, PushwooshToken
 from yak.settings import yak_settings
 
 
-def submit_to_pushwoosh(request_data):
-    url = 'https://cp.pushwoosh.com/json/1.3/createMessage'
-    response = requests.post(url, data=request_data, headers=PushwooshClient.headers)
+class NotificationRenderer(object):
+    """
+    Renders notification messages, keeping compiled templates in memory between calls instead of loading them from
+    disk for every message. Use the module level `notification_renderer` instance rather than creating new ones.
+
+    The site domain used in messages comes from Django's cached `Site.objects.get_current()`.
+    """
+
+    def __init__(self):
+        self.templates = {}
+
+    def clear(self):
+        self.templates = {}
+
+    def get_template(self, location, template_name):
+        key = (location, template_name)
+        if key not in self.templates:
+            self.templates[key] = get_template("notifications/{}/{}".format(location, template_name))
+        return self.templates[key]
+
+    def render(self, notification, location):
+        template = self.get_template(location, notification.message_template_name())
+        return template.render(notification.message_context())
+
+    def render_many(self, notifications, location):
+        """
+        Renders a message for each notification, in order
+        Notifications about the same object from the same reporter with the same template and count are only rendered
+        once
+        """
+        messages = {}
+        results = []
+        for notification in notifications:
+            key = (notification.message_template_name(), notification.content_type_id, notification.object_id,
+                   notification.reporter_id, notification.count)
+            if key not in messages:
+                messages[key] = self.render(notification, location)
+            results.append(messages[key])
+        return results
+
+
+notification_renderer = NotificationRenderer()
+
+
+class NotificationSettingsCache(object):
+    """
+    Keeps each user's saved notification settings in Django's cache backend as a
+    {notification type id: (allow_push, allow_email)} dict, so sending notifications doesn't query them every time.
+    Use the module level `notification_settings_cache` instance rather than creating new ones.
+
+    The users found in the cache (hits) and loaded from the database (misses) are counted in the cache too, so `stats()`
+    covers every process sharing it.
+    """
+    key_prefix = 'yak:notification_settings'
+
+    def key(self, user_id):
+        return "{}:{}".format(self.key_prefix, user_id)
+
+    def count(self, name, amount):
+        if not amount:
+            return
+        key = self.key(name)
+        try:
+            cache.incr(key, amount)
+        except ValueError:
+            # Not counted yet, unless another process started counting meanwhile
+            if not cache.add(key, amount, None):
+                cache.incr(key, amount)
+
+    def stats(self):
+        """
+        The number of users looked up so far, as {'hits': ..., 'misses': ...}
+        """
+        counts = cache.get_many([self.key('hits'), self.key('misses')])
+        return {'hits': counts.get(self.key('hits'), 0), 'misses': counts.get(self.key('misses'), 0)}
+
+    def reset_stats(self):
+        cache.delete_many([self.key('hits'), self.key('misses')])
+
+    def get_many(self, user_ids):
+        """
+        Returns the settings of each user, keyed by user id
+        Users missing from the cache are loaded with a single query
+        """
+        keys = {self.key(user_id): user_id for user_id in user_ids}
+        user_settings = {keys[key]: value for key, value in cache.get_many(keys.keys()).items()}
+        missing_user_ids = [user_id for user_id in user_ids if user_id not in user_settings]
+        self.count('hits', len(user_settings))
+        self.count('misses', len(missing_user_ids))
+
+        if missing_user_ids:
+            loaded_settings = {user_id: {} for user_id in missing_user_ids}
+            for user_id, notification_type_id, allow_push, allow_email in NotificationSetting.objects.filter(
+                    user__in=missing_user_ids).values_list('user', 'notification_type', 'allow_push', 'allow_email'):
+                loaded_settings[user_id][notification_type_id] = (allow_push, allow_email)
+            cache.set_many({self.key(user_id): value for user_id, value in loaded_settings.items()},
+                           yak_settings.NOTIFICATION_SETTINGS_CACHE_TIMEOUT)
+            user_settings.update(loaded_settings)
+
+        return user_settings
+
+    def invalidate(self, user_ids):
+        cache.delete_many([self.key(user_id) for user_id in user_ids])
+
+
+notification_settings_cache = NotificationSettingsCache()
+
+
+class UnreadNotificationCounter(object):
+    """
+    Keeps each user's number of unread notifications in Django's cache backend, so clients polling for a badge don't
+    count them every time. Use the module level `unread_notification_counter` instance rather than creating new ones.
+
+    Counts are only incremented while they're cached. A missing count is counted from the database when next read.
+    """
+    key_prefix = 'yak:unread_notifications'
+
+    def key(self, user_id):
+        return "{}:{}".format(self.key_prefix, user_id)
+
+    def get(self, user_id):
+        count = cache.get(self.key(user_id))
+        if count is None:
+            count = Notification.objects.filter(user_id=user_id, is_read=False).count()
+            cache.add(self.key(user_id), count, yak_settings.UNREAD_NOTIFICATIONS_CACHE_TIMEOUT)
+        return count
+
+    def increment(self, user_ids):
+        for user_id in user_ids:
+            try:
+                cache.incr(self.key(user_id))
+            except ValueError:
+                pass
+
+    def invalidate(self, user_ids):
+        cache.delete_many([self.key(user_id) for user_id in user_ids])
+
+
+unread_notification_counter = UnreadNotificationCounter()
+
+
+@receiver(setting_changed)
+def clear_notification_templates(sender, setting, **kwargs):
+    if setting == 'TEMPLATES':
+        notification_renderer.clear()
+
+
+_pushwoosh_session = None
+_pushwoosh_session_config = None
+
+
+def get_pushwoosh_session():
+    """
+    Returns the shared `requests` session used for Pushwoosh API calls, so connections (and their TLS handshakes) are
+    kept alive and reused between pushes
+
+    `createMessage` isn't idempotent, so only failures Pushwoosh can't have acted on are retried (with exponential
+    backoff): connection errors and 503 responses, honouring their `Retry-After` header. Other errors are returned, as
+    retrying them could send pushes twice. The pool size and retries come from `yak_settings`, and the session is
+    rebuilt if they change.
+    """
+    global _pushwoosh_session, _pushwoosh_session_config
+
+    config = (yak_settings.PUSHWOOSH_POOL_SIZE, yak_settings.PUSHWOOSH_RETRIES, yak_settings.PUSHWOOSH_RETRY_BACKOFF)
+    if _pushwoosh_session is None or config != _pushwoosh_session_config:
+        pool_size, retries, backoff = config
+        # `method_whitelist` was renamed in newer versions of urllib3
+        methods_argument = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                      status_forcelist=(503,), respect_retry_after_header=True, raise_on_status=False,
+                      **{methods_argument: False})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        session = requests.Session()
+        session.headers.update(PushwooshClient.headers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        if _pushwoosh_session is not None:
+            _pushwoosh_session.close()
+        _pushwoosh_session = session
+        _pushwoosh_session_config = config
+
+    return _pushwoosh_session
+
+
+def invoke_pushwoosh(command_name, request_data):
+    """
+    Calls a Pushwoosh API command (e.g., `createMessage`) with JSON `request_data` through the shared session
+    """
+    url = "{}{}".format(yak_settings.PUSHWOOSH_API_URL, command_name)
+    response = get_pushwoosh_session().post(url, data=request_data, timeout=yak_settings.PUSHWOOSH_TIMEOUT)
     return response.json()
 
 
-def send_pushwoosh_notification(receiver, message, deep_link=None):
+def submit_to_pushwoosh(request_data):
+    return invoke_pushwoosh('createMessage', request_data)
+
+
+class PushwooshResult(object):
+    """
+    The outcome of one push queued with `pushwoosh_queue`
+    `response` is Pushwoosh's response to the request it was sent in, and `message_code` is the code Pushwoosh gave
+    this push (None if the request failed). `error` is the exception raised if the request couldn't be made.
+    """
+
+    def __init__(self, notification_data):
+        self.notification_data = notification_data
+        self.response = None
+        self.message_code = None
+        self.error = None
+        self._sent = threading.Event()
+
+    @property
+    def sent(self):
+        return self._sent.is_set()
+
+    def wait(self, timeout=None):
+        self._sent.wait(timeout)
+        return self.response
+
+
+class BatchQueue(object):
+    """
+    Buffers items and sends them in batches, once the batch size setting's worth of items are waiting or the oldest
+    has waited the batch window setting's number of seconds. With a window of 0 every item is sent right away.
+
+    Subclasses name the settings and implement `send(batch)`, or `send_all(pending)` to handle all the items being
+    flushed at once
+
+    Items are only kept in memory: whatever is waiting when the process is killed (or recycled without a clean exit)
+    is lost. Errors sending a batch from the window timer or at exit are logged, as there's no caller to raise them to.
+    """
+    window_setting = None
+    size_setting = None
+    logger = logging.getLogger('yak.rest_notifications')
+
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+        self.timer = None
+
+    @property
+    def window(self):
+        return getattr(yak_settings, self.window_setting)
+
+    @property
+    def batch_size(self):
+        return getattr(yak_settings, self.size_setting)
+
+    def add(self, item):
+        return self.add_many([item])[0]
+
+    def add_many(self, items):
+        results = [self.prepare(item) for item in items]
+        with self.lock:
+            self.pending.extend(results)
+            full = len(self.pending) >= self.batch_size
+            if not full and self.window > 0 and self.timer is None:
+                self.timer = threading.Timer(self.window, self.safe_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+        if full or self.window <= 0:
+            self.flush()
+        return results
+
+    def prepare(self, item):
+        """
+        What's queued (and returned to the caller) for `item`
+        """
+        return item
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if pending:
+            self.send_all(pending)
+
+    def safe_flush(self):
+        """
+        `flush`, logging errors instead of raising them
+        """
+        try:
+            self.flush()
+        except Exception:
+            self.logger.exception("Couldn't send a batch queued with %s", self.__class__.__name__)
+
+    def send_all(self, pending):
+        for start in range(0, len(pending), self.batch_size):
+            self.send(pending[start:start + self.batch_size])
+
+    def send(self, batch):
+        raise NotImplementedError
+
+
+class PushwooshQueue(BatchQueue):
+    """
+    Sends queued pushes as the `notifications` of a single `createMessage` request, per `PUSHWOOSH_BATCH_SIZE` and
+    `PUSHWOOSH_BATCH_WINDOW`
+    Use the module level `pushwoosh_queue` instance rather than creating new ones.
+    """
+    window_setting = 'PUSHWOOSH_BATCH_WINDOW'
+    size_setting = 'PUSHWOOSH_BATCH_SIZE'
+
+    def prepare(self, notification_data):
+        return PushwooshResult(notification_data)
+
+    def send(self, batch):
+        response = None
+        error = None
+        try:
+            request_data = json.dumps({'request': {
+                'notifications': [result.notification_data for result in batch],
+                'auth': yak_settings.PUSHWOOSH_AUTH_TOKEN,
+                'application': yak_settings.PUSHWOOSH_APP_CODE
+            }})
+            response = submit_to_pushwoosh(request_data)
+        except Exception as e:
+            # Every push in the batch shares the failure, not just the one that triggered the flush
+            error = e
+            if self.window > 0:
+                # Queued pushes are fire and forget, so nobody else will see the error
+                self.logger.error("Couldn't send %s queued pushes to Pushwoosh", len(batch), exc_info=error)
+
+        # Pushwoosh returns a message code for each notification, in the order they were sent
+        message_codes = []
+        if isinstance(response, dict) and isinstance(response.get('response'), dict):
+            message_codes = response['response'].get('Messages') or []
+        for index, result in enumerate(batch):
+            result.response = response
+            result.error = error
+            result.message_code = message_codes[index] if index < len(message_codes) else None
+            result._sent.set()
+
+
+pushwoosh_queue = PushwooshQueue()
+atexit.register(pushwoosh_queue.safe_flush)
+
+
+def get_pushwoosh_notification_data(receivers, message, deep_link=None):
+    """
+    A `createMessage` notification of the message to every device of every receiver
+    """
     notification_data = {
         'content': message,
         'send_date': constants.SEND_DATE_NOW,
-        'devices': [token.token for token in receiver.pushwoosh_tokens.all()],
+        'devices': list(PushwooshToken.objects.filter(user__in=receivers).values_list('token', flat=True)),
         'ios_badges': '+1'
     }
 
     if deep_link is not None:
         notification_data['minimize_link'] = 0
         notification_data['link'] = deep_link
+    return notification_data
 
-    request = {'request': {
-        'notifications': [notification_data],
-        'auth': yak_settings.PUSHWOOSH_AUTH_TOKEN,
-        'application': yak_settings.PUSHWOOSH_APP_CODE
-    }}
 
-    request_data = json.dumps(request)
+def get_pushwoosh_response(result):
+    """
+    Pushwoosh's response for a push sent right away, raising the error if the request couldn't be made
+
+    With `PUSHWOOSH_BATCH_WINDOW` set, the push is most likely still queued and the `PushwooshResult` is returned
+    instead, so the caller isn't held up until the batch is sent. Errors sending the batch are logged.
+    """
+    if yak_settings.PUSHWOOSH_BATCH_WINDOW > 0:
+        return result
+    if result.error is not None:
+        raise result.error
+    return result.response
+
+
+def send_pushwoosh_notification(receiver, message, deep_link=None):
+    return send_pushwoosh_notifications([receiver], message, deep_link=deep_link)
+
 
-    return submit_to_pushwoosh(request_data)
+def send_pushwoosh_notifications(receivers, message, deep_link=None):
+    """
+    Sends the same message to every device of every receiver as one notification, through `pushwoosh_queue`
+
+    Returns Pushwoosh's response, or a `PushwooshResult` to wait on if `PUSHWOOSH_BATCH_WINDOW` is set
+    """
+    result = pushwoosh_queue.add(get_pushwoosh_notification_data(receivers, message, deep_link=deep_link))
+    return get_pushwoosh_response(result)
+
+
+PushMessage = namedtuple('PushMessage', ['receivers', 'message', 'deep_link'])
+
+
+class BasePushBackend(object):
+    """
+    Delivers push messages. Subclasses implement `send_many`, which takes a list of `PushMessage`s (the same message to
+    a list of receivers, with an optional deep link) and returns a flat list of results, one for each receiver of each
+    message in order. Receivers sharing a request share its result.
+    """
+
+    def send(self, receiver, message, deep_link=None):
+        return self.send_many([PushMessage([receiver], message, deep_link)])[0]
+
+    def send_many(self, messages):
+        raise NotImplementedError
+
+
+class PushwooshPushBackend(BasePushBackend):
+    """
+    Sends all the messages passed to `send_many` in a single `createMessage` request (up to `PUSHWOOSH_BATCH_SIZE`)
+    """
+
+    def send_many(self, messages):
+        results = pushwoosh_queue.add_many([get_pushwoosh_notification_data(push.receivers, push.message,
+                                                                            deep_link=push.deep_link)
+                                            for push in messages])
+        responses = [get_pushwoosh_response(result) for result in results]
+        return [response for push, response in zip(messages, responses) for receiver in push.receivers]
+
+
+class LoggingPushBackend(BasePushBackend):
+    """
+    Only logs the messages, e.g. for local development or next to another backend
+    """
+    logger = logging.getLogger('yak.rest_notifications.push')
+
+    def send_many(self, messages):
+        for push in messages:
+            self.logger.info("Push to %s: %s (deep link: %s)", ", ".join(str(receiver) for receiver in push.receivers),
+                             push.message, push.deep_link)
+        return [None for push in messages for receiver in push.receivers]
+
+
+class FunctionPushBackend(BasePushBackend):
+    """
+    Wraps a `PUSH_NOTIFICATION_HANDLER` style function, called once per receiver as
+    `handler(receiver, message, deep_link=None)`
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def send(self, receiver, message, deep_link=None):
+        return self.handler(receiver, message, deep_link=deep_link)
+
+    def send_many(self, messages):
+        return [self.send(receiver, push.message, deep_link=push.deep_link)
+                for push in messages for receiver in push.receivers]
+
+
+class PushBackendRegistry(object):
+    """
+    The push backends listed in `PUSH_NOTIFICATION_BACKENDS` (import strings of `BasePushBackend` subclasses), or the
+    `PUSH_NOTIFICATION_HANDLER` function if that's empty. Every message is sent with each backend.
+
+    Backends are imported once and reused, unless those settings change.
+    Use the module level `push_backends` instance rather than creating new ones.
+    """
+
+    def __init__(self):
+        self._backends = None
+        self._config = None
+
+    @property
+    def backends(self):
+        config = (tuple(yak_settings.PUSH_NOTIFICATION_BACKENDS or ()), yak_settings.PUSH_NOTIFICATION_HANDLER)
+        if self._backends is None or config != self._config:
+            backend_paths, handler_path = config
+            if backend_paths:
+                self._backends = [import_string(path)() for path in backend_paths]
+            else:
+                handler = import_string(handler_path)
+                # The default handler sends many messages per request through the Pushwoosh backend
+                self._backends = [PushwooshPushBackend() if handler is send_pushwoosh_notification
+                                  else FunctionPushBackend(handler)]
+            self._config = config
+        return self._backends
+
+    def send(self, receiver, message, deep_link=None):
+        """
+        Returns the result of the first backend
+        """
+        return [backend.send(receiver, message, deep_link=deep_link) for backend in self.backends][0]
+
+    def send_many(self, messages):
+        """
+        Returns the results of the first backend, one for each receiver of each message
+        """
+        return [backend.send_many(messages) for backend in self.backends][0]
+
+
+push_backends = PushBackendRegistry()
 
 
 def send_push_notification(receiver, message, deep_link=None):
-    notification_handler = import_string(yak_settings.PUSH_NOTIFICATION_HANDLER)
-    return notification_handler(receiver, message, deep_link=None)
+    return push_backends.send(receiver, message, deep_link=deep_link)
 
 
-def send_email_notification(receiver, message, reply_to=None):
+def send_push_notifications(receivers, message, deep_link=None):
+    """
+    Sends the same push message to many receivers, in one request if the backend supports it
+    Returns a result for each receiver
+    """
+    return push_backends.send_many([PushMessage(receivers, message, deep_link)])
+
+
+NotificationEmail = namedtuple('NotificationEmail', ['receiver', 'message', 'reply_to'])
+
+
+def build_email_notification(receiver, message, reply_to=None):
     headers = {}
     if reply_to:
         headers['Reply-To'] = reply_to
@@ -54,4 +540,199 @@ def send_email_notification(receiver, message, reply_to=None):
     msg = EmailMultiAlternatives(yak_settings.EMAIL_NOTIFICATION_SUBJECT, text_content, settings.DEFAULT_FROM_EMAIL,
                                  [receiver.email], headers=headers)
     msg.attach_alternative(message, "text/html")
-    msg.send()
+    return msg
+
+
+class EmailQueue(BatchQueue):
+    """
+    Sends queued notification emails over a single mail connection, per `EMAIL_BATCH_SIZE` and `EMAIL_BATCH_WINDOW`
+
+    With `EMAIL_DIGEST`, emails being sent together to the same user are merged into one
+    Use the module level `email_queue` instance rather than creating new ones.
+    """
+    window_setting = 'EMAIL_BATCH_WINDOW'
+    size_setting = 'EMAIL_BATCH_SIZE'
+
+    def send_all(self, pending):
+        if yak_settings.EMAIL_DIGEST:
+            pending = self.digest(pending)
+        messages = [build_email_notification(email.receiver, email.message, reply_to=email.reply_to)
+                    for email in pending]
+
+        connection = get_connection()
+        connection.open()
+        try:
+            for start in range(0, len(messages), self.batch_size):
+                connection.send_messages(messages[start:start + self.batch_size])
+        finally:
+            connection.close()
+
+    def digest(self, pending):
+        emails_by_receiver = OrderedDict()
+        for email in pending:
+            emails_by_receiver.setdefault((email.receiver.email, email.reply_to), []).append(email)
+
+        digests = []
+        for emails in emails_by_receiver.values():
+            message = "\n<hr>\n".join(email.message for email in emails)
+            digests.append(NotificationEmail(emails[0].receiver, message, emails[0].reply_to))
+        return digests
+
+
+email_queue = EmailQueue()
+atexit.register(email_queue.safe_flush)
+
+
+def send_email_notification(receiver, message, reply_to=None):
+    email_queue.add(NotificationEmail(receiver, message, reply_to))
+
+
+def send_email_notifications(receivers, message, reply_to=None):
+    """
+    Sends the same email message to many receivers over one mail connection
+    """
+    email_queue.add_many([NotificationEmail(receiver, message, reply_to) for receiver in receivers])
+
+
+class InProcessSubscription(object):
+    """
+    A user's subscription to an `InProcessNotificationBroker`
+    """
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """
+        Waits up to `timeout` seconds for notifications to be published, and returns everything published since the last
+        call: None for new notifications, or the id of a notification that was updated
+        """
+        try:
+            notification_ids = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while True:
+            try:
+                notification_ids.append(self.queue.get_nowait())
+            except queue.Empty:
+                return notification_ids
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class BaseNotificationBroker(object):
+    """
+    Pub/sub channel, one per receiving user, that new notifications are announced on for the notification stream
+
+    Subclasses implement `publish(user_id, notification_id=None)` and `subscribe(user_id)`, which returns a
+    subscription with the same `get(timeout)` and `close()` methods as `InProcessSubscription`. `notification_id` is
+    only published for notifications updated after they were created; new ones are announced without it.
+    """
+
+    def publish(self, user_id, notification_id=None):
+        raise NotImplementedError
+
+    def publish_many(self, messages):
+        """
+        Publishes a list of (user_id, notification_id) pairs
+        """
+        for user_id, notification_id in messages:
+            self.publish(user_id, notification_id)
+
+    def subscribe(self, user_id):
+        raise NotImplementedError
+
+
+class InProcessNotificationBroker(BaseNotificationBroker):
+    """
+    Only reaches streams served by the same process, so it's meant for tests and development servers
+    """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, user_id, notification_id=None):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.queue.put(notification_id)
+
+    def subscribe(self, user_id):
+        subscription = InProcessSubscription(self, user_id)
+        with self.lock:
+            self.subscriptions[user_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions[subscription.user_id].discard(subscription)
+            if not self.subscriptions[subscription.user_id]:
+                del self.subscriptions[subscription.user_id]
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        notification_ids = []
+        message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        while message is not None:
+            if message['type'] == 'message':
+                notification_ids.append(int(message['data']) if message['data'] else None)
+            message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0)
+        return notification_ids
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisNotificationBroker(BaseNotificationBroker):
+    """
+    Publishes through Redis at `NOTIFICATION_STREAM_REDIS_URL`, so streams served by any process get the
+    notifications. Needs the `redis` package.
+    """
+    channel_prefix = 'yak:notifications'
+
+    def __init__(self):
+        import redis
+        self.client = redis.StrictRedis.from_url(yak_settings.NOTIFICATION_STREAM_REDIS_URL)
+
+    def channel(self, user_id):
+        return "{}:{}".format(self.channel_prefix, user_id)
+
+    def publish(self, user_id, notification_id=None):
+        self.client.publish(self.channel(user_id), notification_id or '')
+
+    def publish_many(self, messages):
+        pipeline = self.client.pipeline(transaction=False)
+        for user_id, notification_id in messages:
+            pipeline.publish(self.channel(user_id), notification_id or '')
+        pipeline.execute()
+
+    def subscribe(self, user_id):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.channel(user_id))
+        return RedisSubscription(pubsub)
+
+
+_notification_broker = None
+_notification_broker_path = None
+
+
+def get_notification_broker():
+    """
+    Returns the shared instance of the `NOTIFICATION_STREAM_BROKER` class, created again if that setting changes
+    """
+    global _notification_broker, _notification_broker_path
+
+    path = yak_settings.NOTIFICATION_STREAM_BROKER
+    if _notification_broker is None or path != _notification_broker_path:
+        _notification_broker = import_string(path)()
+        _notification_broker_path = path
+    return _notification_broker
@@ -1,14 +1,23 @@
-from rest_framework import mixins, generics, status
-from rest_framework.exceptions import AuthenticationFailed
+import time
+from django.db import transaction
+from django.db.models import Max, Q
+from django.http import StreamingHttpResponse
+from rest_framework import mixins, generics, status, views
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
-from pypushwoosh import client, constants
+from pypushwoosh import constants
 from pypushwoosh.command import RegisterDeviceCommand
+from yak.rest_core.pagination import NewestFirstCursorPagination
 from yak.rest_core.permissions import IsOwner
+from yak.rest_core.renderers import EventStreamRenderer
 from yak.rest_notifications.models import NotificationSetting, Notification, create_notification, \
-    PushwooshToken, NotificationType
+    create_notifications, PushwooshToken, NotificationType
 from yak.rest_notifications.serializers import NotificationSettingSerializer, NotificationSerializer, \
-    PushwooshTokenSerializer
+    PushwooshTokenSerializer, MarkNotificationsReadSerializer
+from yak.rest_notifications.utils import invoke_pushwoosh, unread_notification_counter, get_notification_broker
 from yak.rest_social_network.views import CommentViewSet, FollowViewSet, ShareViewSet, LikeViewSet
 from yak.settings import yak_settings
 
@@ -27,10 +36,9 @@ class PushwooshTokenView(generics.CreateAPIView):
         if platform == 'android':
             platform_code = constants.PLATFORM_ANDROID
 
-        push_client = client.PushwooshClient()
         command = RegisterDeviceCommand(yak_settings.PUSHWOOSH_APP_CODE, hwid, platform_code,
                                         serializer.validated_data["token"], language)
-        response = push_client.invoke(command)
+        response = invoke_pushwoosh(command.command_name, command.render())
 
         if response["status_code"] != 200:
             raise AuthenticationFailed("Authentication with notification service failed")
@@ -51,8 +59,33 @@ class NotificationSettingViewSet(mixins.UpdateModelMixin,
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
-    def put(self, request, *args, **kwargs):
+    def get_user_settings(self):
+        """
+        With `LAZY_NOTIFICATION_SETTINGS`, the user's saved settings merged with unsaved defaults for every other type
+        """
         queryset = self.get_queryset()
+        if not yak_settings.LAZY_NOTIFICATION_SETTINGS:
+            return queryset
+
+        saved_settings = {setting.notification_type_id: setting for setting in queryset}
+        user_settings = []
+        for notification_type in NotificationType.objects.order_by('pk'):
+            setting = saved_settings.get(notification_type.pk)
+            if setting is None:
+                setting = NotificationSetting(user=self.request.user, notification_type=notification_type)
+            user_settings.append(setting)
+        return user_settings
+
+    def list(self, request, *args, **kwargs):
+        if not yak_settings.LAZY_NOTIFICATION_SETTINGS:
+            return super(NotificationSettingViewSet, self).list(request, *args, **kwargs)
+
+        page = self.paginate_queryset(self.get_user_settings())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def put(self, request, *args, **kwargs):
+        queryset = self.get_user_settings()
         serializer = self.get_serializer(queryset, data=request.data, many=True, partial=True)
 
         serializer.is_valid(raise_exception=True)
@@ -60,15 +93,145 @@ class NotificationSettingViewSet(mixins.UpdateModelMixin,
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+class NotificationCursorPagination(NewestFirstCursorPagination):
+    """
+    Cursor pagination on (last_activity, id), latest activity first, so notifications that others were folded into
+    come back to the top. One folded into while a client pages through older notifications is picked up by the stream
+    or the next refresh rather than on a later page.
+    """
+    ordering = ('-last_activity', '-id')
+
+
 class NotificationView(generics.ListAPIView):
-    queryset = Notification.objects.all()
+    queryset = Notification.objects.select_related('reporter', 'notification_type').prefetch_related(
+        'content_object', 'other_reporters')
     serializer_class = NotificationSerializer
     permission_classes = (IsOwner,)
+    pagination_class = NotificationCursorPagination
+    ordering = NotificationCursorPagination.ordering
 
     def get_queryset(self):
         return self.queryset.filter(user=self.request.user)
 
 
+class NotificationStreamView(generics.GenericAPIView):
+    """
+    Sends the user's new notifications as they are created, as server-sent events (`Accept: text/event-stream`) or,
+    otherwise, by long polling: the request waits up to `NOTIFICATION_LONG_POLL_TIMEOUT` seconds for notifications and
+    returns them as JSON.
+
+    Clients resume after the last notification id they got, passed as the `Last-Event-ID` header or `last_id`
+    parameter. Streams send a heartbeat comment every `NOTIFICATION_STREAM_HEARTBEAT` seconds without notifications,
+    and end after `NOTIFICATION_STREAM_TIMEOUT` seconds for clients to reconnect. Each open stream holds a server
+    worker, so run these behind a server that handles many long lived connections.
+
+    A notification is sent again when others are aggregated into it, so clients replace the ones they have by id.
+    """
+    queryset = NotificationView.queryset
+    serializer_class = NotificationSerializer
+    permission_classes = (IsAuthenticated,)
+    renderer_classes = (JSONRenderer, EventStreamRenderer)
+    pagination_class = None
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
+
+    def get_last_id(self):
+        last_id = self.request.META.get('HTTP_LAST_EVENT_ID') or self.request.query_params.get('last_id')
+        if last_id is None:
+            # Only notifications created from now on
+            return self.get_queryset().aggregate(last_id=Max('pk'))['last_id'] or 0
+        try:
+            return int(last_id)
+        except ValueError:
+            raise ValidationError({'last_id': "A valid integer is required."})
+
+    def get_new_notifications(self, last_id, updated_ids=()):
+        """
+        Notifications created after `last_id`, plus those in `updated_ids` that were sent before but have since had
+        others aggregated into them, oldest first
+        """
+        return list(self.get_queryset().filter(Q(pk__gt=last_id) | Q(pk__in=updated_ids)).order_by('pk'))
+
+    def get(self, request, *args, **kwargs):
+        last_id = self.get_last_id()
+        # Subscribe before loading anything, so notifications created in between aren't missed
+        subscription = get_notification_broker().subscribe(request.user.pk)
+
+        if request.accepted_renderer.format == EventStreamRenderer.format:
+            response = StreamingHttpResponse(self.stream(subscription, last_id),
+                                             content_type=EventStreamRenderer.media_type)
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        try:
+            notifications = self.get_new_notifications(last_id)
+            if not notifications:
+                published_ids = subscription.get(yak_settings.NOTIFICATION_LONG_POLL_TIMEOUT)
+                if published_ids:
+                    notifications = self.get_new_notifications(
+                        last_id, [pk for pk in published_ids if pk is not None])
+        finally:
+            subscription.close()
+
+        serializer = self.get_serializer(notifications, many=True)
+        last_id = max([last_id] + [notification.pk for notification in notifications])
+        return Response({'results': serializer.data, 'last_id': last_id})
+
+    def stream(self, subscription, last_id):
+        deadline = time.time() + yak_settings.NOTIFICATION_STREAM_TIMEOUT
+        try:
+            notifications = self.get_new_notifications(last_id)
+            while True:
+                if notifications:
+                    serializer = self.get_serializer(notifications, many=True)
+                    for notification, data in zip(notifications, serializer.data):
+                        last_id = max(last_id, notification.pk)
+                        yield EventStreamRenderer.event(data, event='notification', event_id=last_id)
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+
+                published_ids = subscription.get(min(yak_settings.NOTIFICATION_STREAM_HEARTBEAT, remaining))
+                if published_ids:
+                    notifications = self.get_new_notifications(
+                        last_id, [pk for pk in published_ids if pk is not None])
+                else:
+                    notifications = []
+                    yield ": heartbeat\n\n"
+        finally:
+            subscription.close()
+
+
+class UnreadNotificationCountView(views.APIView):
+    """
+    The number of unread notifications, for clients to poll for a badge. Served from `unread_notification_counter`.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        return Response({'count': unread_notification_counter.get(request.user.pk)})
+
+
+class MarkNotificationsReadView(views.APIView):
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        serializer = MarkNotificationsReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        notifications = Notification.objects.filter(user=request.user, is_read=False)
+        ids = serializer.validated_data.get('ids')
+        if ids is not None:
+            notifications = notifications.filter(pk__in=ids)
+        updated = notifications.update(is_read=True)
+        # Recounted on the next read, so notifications created meanwhile aren't lost from the count
+        transaction.on_commit(lambda: unread_notification_counter.invalidate([request.user.pk]))
+        return Response({'marked_read': updated})
+
+
 class NotificationCommentViewSet(CommentViewSet):
     def perform_create(self, serializer):
         obj = serializer.save(user=self.request.user)
@@ -87,8 +250,7 @@ class NotificationShareViewSet(ShareViewSet):
     def perform_create(self, serializer):
         obj = serializer.save(user=self.request.user)
         notification_type = NotificationType.objects.get(slug="share")
-        for receiver in obj.shared_with.all():
-            create_notification(receiver, obj.user, obj.content_object, notification_type)
+        create_notifications(obj.shared_with.all(), obj.user, obj.content_object, notification_type)
 
 
 class NotificationLikeViewSet(LikeViewSet):
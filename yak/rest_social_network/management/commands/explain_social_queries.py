@@ -0,0 +1,53 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand
+from django.db import connection
+from yak.rest_notifications.models import Notification
+from yak.rest_social_network.models import Comment, Follow, Like, Flag, Share
+from yak.rest_user.utils import get_user_content_type
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Prints the database query plans for the common social and notification lookups. ' \
+           'Run it before and after migrating on a populated database to compare index usage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, help='User to look up (defaults to the most recent follower)')
+        parser.add_argument('--content-type-id', type=int,
+                            help='Content type to look up (defaults to that of the most recent comment)')
+        parser.add_argument('--object-id', type=int,
+                            help='Object to look up (defaults to that of the most recent comment)')
+
+    def handle(self, *args, **options):
+        user_content_type = get_user_content_type()
+        latest_follow = Follow.objects.order_by('-pk').first()
+        latest_comment = Comment.objects.order_by('-pk').first()
+
+        user_id = options['user_id'] or (latest_follow.user_id if latest_follow else 0)
+        content_type_id = options['content_type_id'] or (latest_comment.content_type_id if latest_comment else 0)
+        object_id = options['object_id'] or (latest_comment.object_id if latest_comment else 0)
+        content_type = ContentType.objects.get_for_id(content_type_id) if content_type_id else user_content_type
+        content_object_filter = {'content_type': content_type, 'object_id': object_id}
+
+        querysets = [
+            ('Comments on an object',
+             Comment.objects.filter(**content_object_filter).order_by('created', 'id')[:20]),
+            ('Likes on an object', Like.objects.filter(**content_object_filter)),
+            ('Shares of an object', Share.objects.filter(**content_object_filter)),
+            ('Flags on an object', Flag.objects.filter(**content_object_filter)),
+            ('Users a user follows',
+             Follow.objects.filter(user_id=user_id, content_type=user_content_type).order_by('created', 'id')[:20]),
+            ('Followers of a user',
+             Follow.objects.filter(content_type=user_content_type, object_id=user_id).order_by('created', 'id')[:20]),
+            ('Notification inbox', Notification.objects.filter(user_id=user_id).order_by('-created', '-id')[:20]),
+            ('Notifications about an object', Notification.objects.filter(**content_object_filter)),
+        ]
+
+        explain = 'EXPLAIN QUERY PLAN' if connection.vendor == 'sqlite' else 'EXPLAIN'
+        with connection.cursor() as cursor:
+            for name, queryset in querysets:
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute('{} {}'.format(explain, sql), params)
+                self.stdout.write(name)
+                for row in cursor.fetchall():
+                    self.stdout.write('    {}'.format(' '.join(str(column) for column in row)))
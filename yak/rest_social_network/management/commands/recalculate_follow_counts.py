@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from yak.rest_social_network.models import Follow
+from yak.rest_user.utils import get_user_content_type
+
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuilds the denormalized following and followers counts for all users from existing follows'
+
+    def handle(self, *args, **options):
+        user_follows = Follow.objects.filter(content_type=get_user_content_type())
+
+        following = user_follows.filter(user=OuterRef('pk')).order_by().values('user')
+        followers = user_follows.filter(object_id=OuterRef('pk')).order_by().values('object_id')
+
+        updated = User.objects.update(
+            following_count=Coalesce(Subquery(following.annotate(count=Count('pk')).values('count'),
+                                              output_field=IntegerField()), 0),
+            followers_count=Coalesce(Subquery(followers.annotate(count=Count('pk')).values('count'),
+                                              output_field=IntegerField()), 0),
+        )
+        self.stdout.write("Recalculated follow counts for {} users".format(updated))
@@ -0,0 +1,26 @@
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand
+from django.db.models import Count, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from yak.rest_social_network.models import BaseSocialModel, SOCIAL_COUNT_FIELDS
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuilds the denormalized like and comment counts for all social models from existing likes and comments'
+
+    def handle(self, *args, **options):
+        for model in apps.get_models():
+            if not issubclass(model, BaseSocialModel):
+                continue
+
+            content_type = ContentType.objects.get_for_model(model)
+            counts = {}
+            for social_model, count_field in SOCIAL_COUNT_FIELDS.items():
+                related = social_model.objects.filter(content_type=content_type, object_id=OuterRef('pk'))\
+                    .order_by().values('object_id').annotate(count=Count('pk')).values('count')
+                counts[count_field] = Coalesce(Subquery(related, output_field=IntegerField()), 0)
+
+            updated = model.objects.update(**counts)
+            self.stdout.write("Recalculated social counts for {} {} objects".format(updated, model._meta.label))
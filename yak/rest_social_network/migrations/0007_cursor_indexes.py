@@ -0,0 +1,25 @@
+# Generated by Django 2.0.13 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_social_network', '0006_auto_20180209_1859'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['content_type', 'object_id', 'created', 'id'], name='rest_social_content_ee4263_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['user', 'content_type', 'created', 'id'], name='rest_social_user_id_a970f5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='follow',
+            index=models.Index(fields=['content_type', 'object_id', 'created', 'id'], name='rest_social_content_2de209_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.0.13 on 2026-10-18 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_social_network', '0007_cursor_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='flag',
+            index=models.Index(fields=['content_type', 'object_id'], name='rest_social_content_64ed15_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='like',
+            index=models.Index(fields=['content_type', 'object_id'], name='rest_social_content_2f87a2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='share',
+            index=models.Index(fields=['content_type', 'object_id'], name='rest_social_content_b027fc_idx'),
+        ),
+    ]
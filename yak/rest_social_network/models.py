@@ -6,12 +6,13 @@ from django.utils.baseconv import base62
 import re
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models.signals import post_save
-from yak.rest_core.models import CoreModel
+from django.db import models, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from yak.rest_core.models import CoreModel, CountFieldsMixin
 from yak.rest_notifications.models import NotificationType
 from yak.rest_user.models import AbstractYeti
-from yak.settings import yak_settings
+from yak.rest_user.utils import get_user_content_type
 
 
 class FollowableModel(metaclass=abc.ABCMeta):
@@ -56,22 +57,30 @@ def relate_tags(sender, **kwargs):
     Expects tags is stored in a field called 'related_tags' on implementing model
     and it has a parameter called TAG_FIELD to be parsed
     """
-    # If we're saving related_tags, don't save again so we avoid duplicating notifications
-    if kwargs['update_fields'] and 'related_tags' not in kwargs['update_fields']:
+    # If the field holding tags isn't being saved, there is nothing new to relate
+    if kwargs['update_fields'] and sender.TAG_FIELD not in kwargs['update_fields']:
         return
 
-    changed = False
     # Get the text of the field that holds tags. If there is no field specified, use an empty string. If the field's
     # value is None, use an empty string.
     message = getattr(kwargs['instance'], sender.TAG_FIELD, '') or ''
-    for tag in re.findall(r"#[a-zA-Z0-9_-]+", message):
-        tag_obj, created = Tag.objects.get_or_create(name=tag[1:])
-        if tag_obj not in kwargs['instance'].related_tags.all():
-            kwargs['instance'].related_tags.add(tag_obj)
-            changed = True
+    tag_names = {tag[1:] for tag in re.findall(r"#[a-zA-Z0-9_-]+", message)}
+    if not tag_names:
+        return
+
+    existing_names = set(Tag.objects.filter(name__in=tag_names).values_list('name', flat=True))
+    missing_names = tag_names - existing_names
+    if missing_names:
+        try:
+            with transaction.atomic():
+                Tag.objects.bulk_create([Tag(name=name) for name in missing_names])
+        except IntegrityError:
+            # Some of these tags were created by another request in the meantime
+            for name in missing_names:
+                Tag.objects.get_or_create(name=name)
 
-    if changed:
-        kwargs['instance'].save()
+    # `add` skips tags that are already related, so this doesn't need to save the instance again
+    kwargs['instance'].related_tags.add(*Tag.objects.filter(name__in=tag_names))
 
 
 def mentions(sender, **kwargs):
@@ -82,7 +91,7 @@ def mentions(sender, **kwargs):
     This function creates notifications but does not associate mentioned users with the created model instance
     """
     try:
-        from yak.rest_notifications.models import create_notification
+        from yak.rest_notifications.models import create_notifications
     except ImportError:
         return
 
@@ -92,16 +101,16 @@ def mentions(sender, **kwargs):
         message = getattr(kwargs['instance'], sender.TAG_FIELD, '') or ''
         content_object = getattr(kwargs['instance'], 'content_object', kwargs['instance'])
 
-        for user in re.findall(r"@[a-zA-Z0-9_.]+", message):
-            User = get_user_model()
-            try:
-                receiver = User.objects.get(username=user[1:])
-                mention_type = NotificationType.objects.get(slug="mention")
-                create_notification(receiver, kwargs['instance'].user, content_object, mention_type)
-                # Note that for a Comment, this means the notification is associated with the object commented on,
-                # not the comment itself
-            except User.DoesNotExist:
-                pass
+        usernames = {mention[1:] for mention in re.findall(r"@[a-zA-Z0-9_.]+", message)}
+        if not usernames:
+            return
+
+        # Usernames that don't belong to anyone are ignored
+        receivers = get_user_model().objects.filter(username__in=usernames)
+        mention_type = NotificationType.objects.get(slug="mention")
+        # Note that for a Comment, this means the notification is associated with the object commented on,
+        # not the comment itself
+        create_notifications(receivers, kwargs['instance'].user, content_object, mention_type)
 
 
 class Comment(CoreModel):
@@ -117,6 +126,9 @@ class Comment(CoreModel):
 
     class Meta:
         ordering = ['created']
+        indexes = [
+            models.Index(fields=['content_type', 'object_id', 'created', 'id']),
+        ]
 
 
 post_save.connect(mentions, sender=Comment)
@@ -143,6 +155,10 @@ class Follow(CoreModel):
     class Meta:
         unique_together = (("user", "content_type", "object_id"),)
         ordering = ['created']
+        indexes = [
+            models.Index(fields=['user', 'content_type', 'created', 'id']),
+            models.Index(fields=['content_type', 'object_id', 'created', 'id']),
+        ]
 
 
 class Like(CoreModel):
@@ -154,6 +170,9 @@ class Like(CoreModel):
 
     class Meta:
         unique_together = (("user", "content_type", "object_id"),)
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]
 
 
 # Flag an object for review
@@ -166,6 +185,9 @@ class Flag(CoreModel):
 
     class Meta:
         unique_together = (("user", "content_type", "object_id"),)
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]
 
 
 class Share(CoreModel):
@@ -176,29 +198,40 @@ class Share(CoreModel):
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="shares", on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id']),
+        ]
+
 
-class AbstractSocialYeti(AbstractYeti):
+class AbstractSocialYeti(CountFieldsMixin, AbstractYeti):
     follows = GenericRelation(Follow)
 
+    # Denormalized counts of user follows, kept current by `update_follow_counts`
+    # Use the `recalculate_follow_counts` management command to rebuild them
+    following_count = models.PositiveIntegerField(default=0)
+    followers_count = models.PositiveIntegerField(default=0)
+    COUNT_FIELDS = ('following_count', 'followers_count')
+
     class Meta:
         abstract = True
 
     def user_following(self):
         return self.following.filter(
-            content_type=ContentType.objects.get(app_label=yak_settings.USER_APP_LABEL, model=yak_settings.USER_MODEL)
+            content_type=get_user_content_type()
         )
 
     def user_followers(self):
         return Follow.objects.filter(
-            content_type=ContentType.objects.get(app_label=yak_settings.USER_APP_LABEL, model=yak_settings.USER_MODEL),
+            content_type=get_user_content_type(),
             object_id=self.pk
         )
 
     def user_following_count(self):
-        return self.user_following().count()
+        return self.following_count
 
     def user_followers_count(self):
-        return self.user_followers().count()
+        return self.followers_count
 
     def identifier(self):
         return "{}".format(self.username)
@@ -207,15 +240,58 @@ class AbstractSocialYeti(AbstractYeti):
         return "user"
 
 
-class BaseSocialModel(models.Model):
+def update_follow_counts(sender, **kwargs):
+    """
+    Receiver function for `post_save` and `post_delete` signals on `Follow`
+
+    Keeps the denormalized `following_count` and `followers_count` on the user model current when a user follows or
+    unfollows another user
+    """
+    User = get_user_model()
+    if not issubclass(User, AbstractSocialYeti):
+        return
+
+    follow = kwargs['instance']
+    if follow.content_type_id != get_user_content_type().pk:
+        return
+
+    if 'created' in kwargs:
+        if not kwargs['created']:
+            return
+        User.objects.filter(pk=follow.user_id).update(following_count=F('following_count') + 1)
+        User.objects.filter(pk=follow.object_id).update(followers_count=F('followers_count') + 1)
+    else:
+        User.objects.filter(pk=follow.user_id, following_count__gt=0).update(
+            following_count=F('following_count') - 1)
+        User.objects.filter(pk=follow.object_id, followers_count__gt=0).update(
+            followers_count=F('followers_count') - 1)
+
+
+post_save.connect(update_follow_counts, sender=Follow)
+post_delete.connect(update_follow_counts, sender=Follow)
+
+
+class BaseSocialModel(CountFieldsMixin, models.Model):
     """
     This is an abstract model to be inherited by the main "object" being used in feeds on a social media application.
     It expects that object to override the methods below.
     """
 
+    # Denormalized counts of likes and comments, kept current by `update_social_counts`
+    # Use the `recalculate_social_counts` management command to rebuild them
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+    COUNT_FIELDS = ('like_count', 'comment_count')
+
     class Meta:
         abstract = True
 
+    def likes_count(self):
+        return self.like_count
+
+    def comments_count(self):
+        return self.comment_count
+
     def url(self):
         current_site = Site.objects.get_current()
         return "http://{0}/{1}/".format(current_site.domain, base62.encode(self.pk))
@@ -226,3 +302,38 @@ class BaseSocialModel(models.Model):
 
     def create_social_message(self, provider):
         raise NotImplementedError("This has not been implemented")
+
+
+# Maps social models to the counter they update on `BaseSocialModel`
+SOCIAL_COUNT_FIELDS = {
+    Like: 'like_count',
+    Comment: 'comment_count',
+}
+
+
+def update_social_counts(sender, **kwargs):
+    """
+    Receiver function for `post_save` and `post_delete` signals on `Like` and `Comment`
+
+    Keeps the denormalized `like_count` and `comment_count` current on the `BaseSocialModel` that was liked or
+    commented on
+    """
+    instance = kwargs['instance']
+    model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    if model is None or not issubclass(model, BaseSocialModel):
+        return
+
+    count_field = SOCIAL_COUNT_FIELDS[sender]
+    if 'created' in kwargs:
+        if not kwargs['created']:
+            return
+        model.objects.filter(pk=instance.object_id).update(**{count_field: F(count_field) + 1})
+    else:
+        model.objects.filter(pk=instance.object_id, **{'{}__gt'.format(count_field): 0}).update(
+            **{count_field: F(count_field) - 1})
+
+
+post_save.connect(update_social_counts, sender=Like)
+post_delete.connect(update_social_counts, sender=Like)
+post_save.connect(update_social_counts, sender=Comment)
+post_delete.connect(update_social_counts, sender=Comment)
@@ -1,5 +1,6 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from yak.rest_core.serializers import YAKListSerializer
 from yak.rest_social_network.models import Tag, Comment, Follow, Flag, Share, Like
 from yak.rest_user.serializers import UserSerializer
 
@@ -8,11 +9,33 @@ User = get_user_model()
 
 
 class LikedMixin(object):
+    def prefetch_liked_id(self, instances):
+        """
+        Called by `YAKListSerializer` to look up the logged in user's likes for a whole page in one query
+        """
+        self._liked_ids = {}
+        request = self.context['request']
+        if not request.user.is_authenticated or not instances:
+            return
+
+        self._liked_ids = {(self.get_content_type(obj), obj.pk): None for obj in instances}
+        likes = Like.objects.filter(
+            user=request.user,
+            content_type__in={content_type for content_type, object_id in self._liked_ids},
+            object_id__in={object_id for content_type, object_id in self._liked_ids}
+        ).values_list('content_type', 'object_id', 'pk')
+        for content_type, object_id, like_id in likes:
+            if (content_type, object_id) in self._liked_ids:
+                self._liked_ids[(content_type, object_id)] = like_id
+
     def get_liked_id(self, obj):
         request = self.context['request']
         if request.user.is_authenticated:
+            content_type = self.get_content_type(obj)
+            liked_ids = getattr(self, '_liked_ids', {})
+            if (content_type, obj.pk) in liked_ids:
+                return liked_ids[(content_type, obj.pk)]
             try:
-                content_type = self.get_content_type(obj)
                 return Like.objects.get(content_type=content_type, user=request.user, object_id=obj.pk).pk
             except Like.DoesNotExist:
                 pass
@@ -20,12 +43,33 @@ class LikedMixin(object):
 
 
 class FollowedMixin(object):
+    def prefetch_follow_id(self, instances):
+        """
+        Called by `YAKListSerializer` to look up the logged in user's follows for a whole page in one query
+        """
+        self._follow_ids = {}
+        user = self.context['request'].user
+        if not user.is_authenticated or not instances:
+            return
+
+        self._follow_ids = {(self.get_content_type(obj), obj.pk): None for obj in instances}
+        follows = user.following.filter(
+            content_type__in={content_type for content_type, object_id in self._follow_ids},
+            object_id__in={object_id for content_type, object_id in self._follow_ids}
+        ).values_list('content_type', 'object_id', 'pk')
+        for content_type, object_id, follow_id in follows:
+            if (content_type, object_id) in self._follow_ids:
+                self._follow_ids[(content_type, object_id)] = follow_id
+
     def get_follow_id(self, obj):
         # Indicate whether or not the logged in user is following a given object (e.g., another user)
         # Provide the id of the follow object so it can be deleted to unfollow the object
         if self.context['request'].user.is_authenticated:
+            content_type = self.get_content_type(obj)
+            follow_ids = getattr(self, '_follow_ids', {})
+            if (content_type, obj.pk) in follow_ids:
+                return follow_ids[(content_type, obj.pk)]
             try:
-                content_type = self.get_content_type(obj)
                 return self.context['request'].user.following.get(content_type=content_type, object_id=obj.pk).pk
             except Follow.DoesNotExist:
                 pass
@@ -58,8 +102,21 @@ class FollowSerializer(serializers.ModelSerializer):
     class Meta:
         model = Follow
         fields = ['id', 'follower', 'following', 'created', 'content_type', 'object_id']
+        list_serializer_class = YAKListSerializer
+
+    def prefetch_following(self, instances):
+        """
+        Called by `YAKListSerializer` to load and serialize the followed users for a whole page at once
+        """
+        users = User.objects.in_bulk({follow.object_id for follow in instances})
+        serializer = UserSerializer(list(users.values()), many=True, context={'request': self.context.get('request')})
+        self._following = {user.pk: data for user, data in zip(users.values(), serializer.data)}
 
     def get_user_follow(self, obj):
+        following = getattr(self, '_following', {})
+        if obj.object_id in following:
+            return following[obj.object_id]
+
         user = User.objects.get(pk=obj.object_id)
         serializer = UserSerializer(user, context={'request': self.context.get('request')})
         return serializer.data
@@ -1,8 +1,7 @@
-import rest_framework
 from rest_framework.response import Response
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import detail_route, list_route
-from yak.rest_core.utils import get_package_version
+from yak.rest_core.pagination import CreatedCursorPagination
 from yak.rest_social_network.models import Tag, Comment, Follow, Flag, Share, Like
 from yak.rest_social_network.serializers import TagSerializer, CommentSerializer, FollowSerializer, FlagSerializer, \
     ShareSerializer, LikeSerializer
@@ -12,7 +11,6 @@ from django.contrib.auth import get_user_model
 
 
 User = get_user_model()
-drf_version = get_package_version(rest_framework)
 
 
 class TagViewSet(viewsets.ModelViewSet):
@@ -24,6 +22,8 @@ class CommentViewSet(viewsets.ModelViewSet):
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     filter_fields = ('content_type', 'object_id')
+    pagination_class = CreatedCursorPagination
+    ordering = CreatedCursorPagination.ordering
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -33,7 +33,7 @@ class CommentViewSet(viewsets.ModelViewSet):
 
 
 class FollowViewSet(viewsets.ModelViewSet):
-    queryset = Follow.objects.all()
+    queryset = Follow.objects.select_related('user')
     serializer_class = FollowSerializer
 
     def perform_create(self, serializer):
@@ -88,27 +88,21 @@ class SocialUserViewSet(UserViewSet):
     @detail_route(methods=['get'])
     def following(self, request, pk):
         requested_user = User.objects.get(pk=pk)
-        following = requested_user.user_following()
+        following = requested_user.user_following().select_related('user')
 
-        if drf_version[0] >= 3 and drf_version[1] < 1:
-            result_page = self.paginate_queryset(following)
-        else:
-            paginator = FollowViewSet().paginator
-            result_page = paginator.paginate_queryset(following, request)
+        paginator = CreatedCursorPagination()
+        result_page = paginator.paginate_queryset(following, request)
 
         serializer = FollowSerializer(instance=result_page, many=True, context={'request': request})
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
     @detail_route(methods=['get'])
     def followers(self, request, pk):
         requested_user = User.objects.get(pk=pk)
-        followers = requested_user.user_followers()
+        followers = requested_user.user_followers().select_related('user')
 
-        if drf_version[0] >= 3 and drf_version[1] < 1:
-            result_page = self.paginate_queryset(followers)
-        else:
-            paginator = FollowViewSet().paginator
-            result_page = paginator.paginate_queryset(followers, request)
+        paginator = CreatedCursorPagination()
+        result_page = paginator.paginate_queryset(followers, request)
 
         serializer = FollowSerializer(instance=result_page, many=True, context={'request': request})
-        return Response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
@@ -1,11 +1,13 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import default_token_generator
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.shortcuts import get_current_site
 from django.template import loader
 from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 from oauth2_provider.models import Application
+from yak.settings import yak_settings
 
 
 def create_auth_client(sender, instance=None, created=False, **kwargs):
@@ -18,6 +20,16 @@ def create_auth_client(sender, instance=None, created=False, **kwargs):
                                    authorization_grant_type=Application.GRANT_CLIENT_CREDENTIALS)
 
 
+def get_user_content_type():
+    """
+    Returns the ContentType of the user model configured in `yak_settings`
+
+    Goes through Django's ContentType cache, so this only queries the database once per process. The cache is cleared
+    by Django whenever content types are flushed and recreated (e.g., between tests).
+    """
+    return ContentType.objects.get_by_natural_key(yak_settings.USER_APP_LABEL, yak_settings.USER_MODEL)
+
+
 def reset_password(request, email, subject_template_name='users/password_reset_subject.txt',
                    rich_template_name='users/password_reset_email_rich.html',
                    template_name='users/password_reset_email.html'):
@@ -60,10 +60,33 @@ DEFAULTS = {
     'SOCIAL_MODEL': "test_app.models.Post",
     'ALLOW_EMAIL': True,
     'ALLOW_PUSH': True,
+    'NOTIFICATION_AGGREGATION_WINDOW': 0,
+    'NOTIFICATION_AGGREGATION_REPORTERS': 3,
     'EMAIL_NOTIFICATION_SUBJECT': 'Test Project Notification',
+    'EMAIL_BATCH_WINDOW': 0,
+    'EMAIL_BATCH_SIZE': 100,
+    'EMAIL_DIGEST': False,
     'PUSHWOOSH_AUTH_TOKEN': "",
     'PUSHWOOSH_APP_CODE': "",
+    'PUSHWOOSH_API_URL': "https://cp.pushwoosh.com/json/1.3/",
+    'PUSHWOOSH_POOL_SIZE': 10,
+    'PUSHWOOSH_TIMEOUT': 10,
+    'PUSHWOOSH_RETRIES': 3,
+    'PUSHWOOSH_RETRY_BACKOFF': 0.5,
+    'PUSHWOOSH_BATCH_WINDOW': 0,
+    'PUSHWOOSH_BATCH_SIZE': 100,
     'PUSH_NOTIFICATION_HANDLER': "yak.rest_notifications.utils.send_pushwoosh_notification",
+    'PUSH_NOTIFICATION_BACKENDS': [],
+    'ASYNC_NOTIFICATIONS': False,
+    'ASYNC_NOTIFICATIONS_EAGER': False,
+    'LAZY_NOTIFICATION_SETTINGS': False,
+    'NOTIFICATION_SETTINGS_CACHE_TIMEOUT': 60 * 60,
+    'UNREAD_NOTIFICATIONS_CACHE_TIMEOUT': 60 * 60 * 24,
+    'NOTIFICATION_STREAM_BROKER': "yak.rest_notifications.utils.InProcessNotificationBroker",
+    'NOTIFICATION_STREAM_REDIS_URL': "redis://localhost:6379/0",
+    'NOTIFICATION_STREAM_HEARTBEAT': 15,
+    'NOTIFICATION_STREAM_TIMEOUT': 5 * 60,
+    'NOTIFICATION_LONG_POLL_TIMEOUT': 30,
     'SOCIAL_SHARE_DELAY': 60,
     'USE_FACEBOOK_OG': False,
     'FACEBOOK_OG_NAMESPACE': "",